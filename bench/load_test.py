@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный тест и замер задержек для iot_simple_server.py (и Flask-заглушки test_server/test.py).
+
+Поднимает сервер на 127.0.0.1 со свободным портом (FAKE_TEMP=1), гоняет смесь:
+  - N «дашбордов», каждый опрашивает /api/state раз в --poll-ms по своему keep-alive соединению;
+  - загрузки страницы (/ + style.css) с заданной частотой;
+  - пачки команд (/api/modem/power + POST /api/batch).
+Печатает/пишет JSON: пропускная способность, p50/p95/p99 по типам запросов, RSS сервера.
+
+    python bench/load_test.py --dashboards 6 --duration 30 --out run-before.json
+    python bench/load_test.py --target flask --dashboards 6
+    python bench/load_test.py --env HTTP_ENGINE=single      # сравнить режимы
+    python bench/load_test.py --target flask --env SCENARIO=antenna_slew --env SCENARIO_SPEED=20 --env SCENARIO_LOOP=1
+                                                            # на фоне частых изменений state (test_server/scenarios)
+"""
+
+import os, sys, json, time, socket, random, argparse, threading, subprocess, http.client, platform
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+# ---- сервер ----
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(target:str, port:int, extra_env:dict):
+    env = dict(os.environ, FAKE_TEMP="1", HTTP_HOST="127.0.0.1", HTTP_PORT=str(port), DOC_ROOT=ROOT)
+    env.update(extra_env)
+    if target == "iot":
+        cmd = [sys.executable, os.path.join(ROOT, "iot_simple_server.py")]
+        cwd = ROOT
+    else:
+        # без debug/reloader: иначе Flask порождает второй процесс
+        cmd = [sys.executable, "-c",
+               f"import test; test.app.run(host='127.0.0.1', port={port}, debug=False, threaded=True)"]
+        cwd = os.path.join(ROOT, "test_server")
+    proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"сервер завершился при старте (код {proc.returncode})")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise SystemExit("сервер не начал слушать порт за 15 с")
+
+
+def rss_kb(pid:int):
+    """VmRSS процесса из /proc (Linux); None, если недоступно."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+# ---- клиенты ----
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}   # тип -> [мс]
+        self.errors = {}    # тип -> число
+        self.bytes = 0
+
+    def add(self, kind:str, ms:float, ok:bool, nbytes:int):
+        with self.lock:
+            if ok:
+                self.samples.setdefault(kind, []).append(ms)
+                self.bytes += nbytes
+            else:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+class Client:
+    """Одно keep-alive соединение; при обрыве переподключается."""
+
+    def __init__(self, port:int, rec:Recorder):
+        self.port, self.rec, self.conn = port, rec, None
+
+    def request(self, kind:str, path:str, method:str="GET", body=None, headers=None):
+        t0 = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+            self.conn.request(method, path, body=body, headers=headers or {})
+            r = self.conn.getresponse()
+            data = r.read()
+            ok = r.status < 400
+            if r.will_close:
+                self.conn.close()
+                self.conn = None
+        except (OSError, http.client.HTTPException):
+            if self.conn is not None:
+                self.conn.close()
+            self.conn, ok, data = None, False, b""
+        self.rec.add(kind, (time.perf_counter() - t0) * 1000, ok, len(data))
+
+
+def every(period:float, stop:threading.Event, fn, jitter:bool=True):
+    """fn() раз в period секунд до stop (первый запуск со случайным сдвигом)."""
+    t_next = time.perf_counter() + (random.random() * period if jitter else 0)
+    while not stop.is_set():
+        delay = t_next - time.perf_counter()
+        if delay > 0 and stop.wait(delay):
+            break
+        fn()
+        t_next += period
+
+
+def dashboard(port, rec, stop, poll_s):
+    c = Client(port, rec)
+    every(poll_s, stop, lambda: c.request("state", "/api/state"))
+
+
+def page_loads(port, rec, stop, period):
+    c = Client(port, rec)
+
+    def load():
+        c.request("page", "/", headers={"Accept-Encoding": "gzip"})
+        c.request("asset", "/style.css", headers={"Accept-Encoding": "gzip"})
+    every(period, stop, load)
+
+
+def command_bursts(port, rec, stop, period, size):
+    c = Client(port, rec)
+
+    def burst():
+        for i in range(size):
+            c.request("command", f"/api/modem/power?state={'on' if i % 2 else 'off'}")
+        ops = [{"op": "ssid", "value": "Orion"}, {"op": "wifi_password", "value": "12345678"}]
+        c.request("batch", "/api/batch", "POST", json.dumps({"ops": ops}),
+                  {"Content-Type": "application/json"})
+    every(period, stop, burst)
+
+
+# ---- отчёт ----
+def percentile(sorted_ms:list, p:float) -> float:
+    if not sorted_ms:
+        return None
+    k = max(0, min(len(sorted_ms) - 1, int(round(p / 100.0 * len(sorted_ms) + 0.5)) - 1))
+    return round(sorted_ms[k], 3)
+
+
+def summarize(rec:Recorder, seconds:float) -> dict:
+    ops, total = {}, 0
+    for kind in sorted(set(rec.samples) | set(rec.errors)):
+        ms = sorted(rec.samples.get(kind, []))
+        total += len(ms)
+        ops[kind] = {
+            "count": len(ms),
+            "errors": rec.errors.get(kind, 0),
+            "rps": round(len(ms) / seconds, 2),
+            "p50_ms": percentile(ms, 50),
+            "p95_ms": percentile(ms, 95),
+            "p99_ms": percentile(ms, 99),
+            "max_ms": round(ms[-1], 3) if ms else None,
+        }
+    return {"requests": total, "errors": sum(rec.errors.values()),
+            "throughput_rps": round(total / seconds, 2), "bytes": rec.bytes, "ops": ops}
+
+
+def git_rev():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--target", choices=("iot", "flask"), default="iot")
+    ap.add_argument("--port", type=int, default=0, help="не запускать сервер, а бить в уже запущенный")
+    ap.add_argument("--dashboards", type=int, default=6)
+    ap.add_argument("--poll-ms", type=float, default=500)
+    ap.add_argument("--page-every", type=float, default=10, help="сек. между загрузками страницы (0 — выкл.)")
+    ap.add_argument("--burst-every", type=float, default=5, help="сек. между пачками команд (0 — выкл.)")
+    ap.add_argument("--burst-size", type=int, default=5)
+    ap.add_argument("--duration", type=float, default=20, help="сек. нагрузки")
+    ap.add_argument("--env", action="append", default=[], help="KEY=VALUE для процесса сервера")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", help="записать JSON в файл (иначе — stdout)")
+    args = ap.parse_args()
+    random.seed(args.seed)
+
+    extra_env = dict(kv.split("=", 1) for kv in args.env)
+    proc = None
+    port = args.port
+    if not port:
+        port = free_port()
+        proc = start_server(args.target, port, extra_env)
+
+    rec, stop = Recorder(), threading.Event()
+    workers = [threading.Thread(target=dashboard, args=(port, rec, stop, args.poll_ms / 1000.0))
+               for _ in range(args.dashboards)]
+    if args.page_every > 0:
+        workers.append(threading.Thread(target=page_loads, args=(port, rec, stop, args.page_every)))
+    if args.burst_every > 0:
+        workers.append(threading.Thread(target=command_bursts,
+                                        args=(port, rec, stop, args.burst_every, args.burst_size)))
+    rss = []
+    try:
+        t0 = time.perf_counter()
+        for w in workers:
+            w.daemon = True
+            w.start()
+        while time.perf_counter() - t0 < args.duration:
+            time.sleep(0.5)
+            if proc is not None:
+                kb = rss_kb(proc.pid)
+                if kb is not None:
+                    rss.append(kb)
+        stop.set()
+        for w in workers:
+            w.join(timeout=15)
+        seconds = time.perf_counter() - t0
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=5)
+
+    report = {
+        "target": args.target,
+        "git": git_rev(),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k != "out"},
+        "duration_s": round(seconds, 3),
+        "rss_kb": {"max": max(rss), "end": rss[-1]} if rss else None,
+    }
+    report.update(summarize(rec, seconds))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
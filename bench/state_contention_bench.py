@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк конкуренции за состояние: сколько раз в секунду читатели получают
+JSON /api/state, пока писатель (как uart_reader) шлёт обновления с заданной частотой.
+
+    python bench/state_contention_bench.py
+    python bench/state_contention_bench.py --readers 8 --rates 0,10,100,1000,0 --seconds 2
+
+Режимы:
+  cow    — текущий код: state_snapshot() без блокировок, писатель публикует новый снимок;
+  locked — прежняя схема для сравнения: общий Lock вокруг изменяемого dict и json.dumps на каждое чтение.
+Частота 0 в --rates означает «писатель не работает»; "max" — писать без пауз.
+"""
+
+import os, sys, json, time, threading, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import iot_simple_server as srv
+
+
+def cow_reader():
+    srv.state_snapshot()
+
+
+def cow_writer(i:int):
+    srv.apply_uart_updates([(("temp_c",), 40 + i % 300 / 10), (("angles", "tilt_current"), i % 900)])
+
+
+LEGACY_LOCK = threading.Lock()
+LEGACY_STATE = json.loads(json.dumps(srv.STATE))
+
+
+def locked_reader():
+    with LEGACY_LOCK:
+        json.dumps(LEGACY_STATE, ensure_ascii=False).encode("utf-8")
+
+
+def locked_writer(i:int):
+    with LEGACY_LOCK:
+        LEGACY_STATE["temp_c"] = 40 + i % 300 / 10
+        LEGACY_STATE["angles"]["tilt_current"] = i % 900
+        LEGACY_STATE["last_update"] = time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def measure(reader, writer, readers:int, rate, seconds:float) -> dict:
+    stop = threading.Event()
+    counts = [0] * readers
+    writes = [0]
+
+    def read_loop(k):
+        n = 0
+        while not stop.is_set():
+            reader()
+            n += 1
+        counts[k] = n
+
+    def write_loop():
+        i = 0
+        period = 0 if rate == "max" else 1.0 / rate
+        t_next = time.perf_counter()
+        while not stop.is_set():
+            writer(i)
+            i += 1
+            if period:
+                t_next += period
+                delay = t_next - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        writes[0] = i
+
+    threads = [threading.Thread(target=read_loop, args=(k,)) for k in range(readers)]
+    if rate:
+        threads.append(threading.Thread(target=write_loop))
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return {"reads_per_s": sum(counts) / seconds, "writes_per_s": writes[0] / seconds}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--readers", type=int, default=4, help="потоков-читателей")
+    ap.add_argument("--rates", default="0,10,100,1000,max", help="частоты писателя, Гц, через запятую")
+    ap.add_argument("--seconds", type=float, default=2.0, help="длительность каждого замера")
+    ap.add_argument("--mode", choices=("cow", "locked", "both"), default="both")
+    args = ap.parse_args()
+
+    modes = {"cow": (cow_reader, cow_writer), "locked": (locked_reader, locked_writer)}
+    selected = list(modes) if args.mode == "both" else [args.mode]
+    rates = [r if r == "max" else float(r) for r in args.rates.split(",")]
+    print(f"читателей: {args.readers}, {args.seconds} с на замер")
+    for mode in selected:
+        reader, writer = modes[mode]
+        for rate in rates:
+            r = measure(reader, writer, args.readers, rate, args.seconds)
+            label = "нет" if not rate else (rate if rate == "max" else f"{rate:g} Гц")
+            print(f"  {mode:<6} писатель {label:>9}: {r['reads_per_s']:>12,.0f} чтений/с  "
+                  f"{r['writes_per_s']:>10,.0f} записей/с")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Микро-бенчмарк разбора UART: старый путь (readline + посимвольный фильтр)
+против UartFramer (крупные куски + bytes.translate).
+
+    python bench/uart_parser_bench.py                 # синтетический поток
+    python bench/uart_parser_bench.py dump1.bin ...   # сырые байты с порта или захват tools/uart_capture.py
+    python bench/uart_parser_bench.py --chunk 512 --apply
+
+Печатает кадры/с и МБ/с для каждого потока.
+"""
+
+import os, sys, io, json, time, random, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import iot_simple_server as srv
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools"))
+from uart_capture import load_bytes
+
+
+def synthetic_stream(frames:int, seed:int=1) -> bytes:
+    """Похоже на живой порт: кадры TEMP, болтовня прошивки, обрывки и нечитаемые байты."""
+    rnd = random.Random(seed)
+    out = []
+    for i in range(frames):
+        r = rnd.random()
+        if r < 0.80:
+            out.append(b'{"TEMP": %.2f}\r\n' % (35 + rnd.random() * 30))
+        elif r < 0.90:
+            out.append(b"I (%d) wifi: state: run -> run (0)\r\n" % i)
+        elif r < 0.95:
+            out.append(bytes(rnd.randrange(256) for _ in range(rnd.randrange(4, 40))) + b"\n")
+        else:
+            out.append(b'{"TEMP": 4\xff\x005.0}\n')
+    return b"".join(out)
+
+
+def legacy_parse(data:bytes, apply:bool) -> int:
+    """Копия прежнего цикла uart_reader (SER.readline заменён на BytesIO)."""
+    f = io.BytesIO(data)
+    n = 0
+    while True:
+        raw = f.readline()
+        if not raw:
+            break
+        text = raw.decode("utf-8", errors="ignore").strip()
+        text = "".join(ch for ch in text if ch in "\r\n\t" or (32 <= ord(ch) <= 126)).strip()
+        if not text:
+            continue
+        try:
+            obj = json.loads(text)
+        except Exception:
+            continue
+        if isinstance(obj, dict) and "TEMP" in obj:
+            try:
+                val = float(obj["TEMP"])
+            except Exception:
+                continue
+            if apply:
+                with srv.state_write() as st:
+                    st["temp_c"] = val
+            n += 1
+    return n
+
+
+def framer_parse(data:bytes, chunk:int, apply:bool) -> int:
+    """Как новый uart_reader: поля всех кадров куска применяются к STATE одной пачкой."""
+    framer = srv.UartFramer()
+    n = 0
+    for i in range(0, len(data), chunk):
+        updates = []
+        for frame in framer.feed(data[i:i + chunk]):
+            n += srv.uart_frame_updates(frame, updates) > 0
+        if apply:
+            srv.apply_uart_updates(updates)
+    return n
+
+
+def run(name:str, fn, data:bytes, repeat:int):
+    best, frames = None, 0
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        frames = fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    print(f"  {name:<8} {frames:>8} кадров  {frames / best:>12,.0f} кадр/с  "
+          f"{len(data) / best / 1e6:>7.2f} МБ/с")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("files", nargs="*", help="сырые байты UART или файлы захвата (.cap)")
+    ap.add_argument("--frames", type=int, default=200000, help="размер синтетического потока (строк)")
+    ap.add_argument("--chunk", type=int, default=256, help="размер куска для UartFramer.feed, байт")
+    ap.add_argument("--repeat", type=int, default=3, help="прогонов, берётся лучший")
+    ap.add_argument("--apply", action="store_true", help="учитывать запись в STATE")
+    args = ap.parse_args()
+
+    streams = [(path, load_bytes(path)) for path in args.files]
+    if not streams:
+        streams = [("synthetic", synthetic_stream(args.frames))]
+    for name, data in streams:
+        print(f"{name}: {len(data)} байт")
+        run("legacy", lambda: legacy_parse(data, args.apply), data, args.repeat)
+        run("framer", lambda: framer_parse(data, args.chunk, args.apply), data, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
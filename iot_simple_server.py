@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os, sys, time, json, threading, mimetypes, socket
+import os, sys, time, json, hmac, threading, mimetypes, socket, queue, zlib, struct, mmap, bisect, heapq, selectors, signal
+from array import array
+from collections import deque, OrderedDict
+from itertools import islice
+from email.utils import formatdate, parsedate_to_datetime
+from contextlib import contextmanager
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import urlparse, parse_qs, unquote
+from urllib.parse import parse_qsl, unquote
 
 # ---- pyserial может отсутствовать: безопасно обрабатываем ----
 try:
@@ -24,9 +29,89 @@ DOC_ROOT    = os.path.abspath(os.environ.get("DOC_ROOT", "."))
 # Эмуляция температуры, если нет UART (или просто для теста).
 FAKE_TEMP   = os.environ.get("FAKE_TEMP", "1") in ("1", "true", "True")
 FAKE_PERIOD = float(os.environ.get("FAKE_PERIOD", "2.0"))
+FAKE_TEMP_MAX = float(os.environ.get("FAKE_TEMP_MAX", "65"))  # верх «пилы» эмулятора (выше порогов — проверка термозащиты)
+UART_MAX_LINE = int(os.environ.get("UART_MAX_LINE", "1024"))  # длиннее — мусор, выбрасываем
+
+# Парк устройств (шлюз на несколько постов): FLEET="post1=/dev/ttyUSB0,post2=/dev/ttyUSB1@57600",
+# FLEET_SIM — сколько симулированных устройств добавить (sim-001, ...; период — FAKE_PERIOD)
+FLEET     = os.environ.get("FLEET", "")
+FLEET_SIM = int(os.environ.get("FLEET_SIM", "0"))
+
+# Команды модему по UART: ожидание ACK, повторы, сколько завершённых помнить для /api/commands
+COMMAND_TIMEOUT = float(os.environ.get("COMMAND_TIMEOUT", "2.0"))
+COMMAND_RETRIES = int(os.environ.get("COMMAND_RETRIES", "2"))
+COMMAND_KEEP    = int(os.environ.get("COMMAND_KEEP", "100"))
+
+# История телеметрии: отсчётов на канал (12 байт каждый, память выделяется сразу при первом отсчёте)
+HISTORY_SIZE = int(os.environ.get("HISTORY_SIZE", "36000"))
+
+# Журнал телеметрии на флеше (выключен, если TELEMETRY_DIR пуст)
+TELEMETRY_DIR           = os.environ.get("TELEMETRY_DIR", "")
+TELEMETRY_FLUSH         = float(os.environ.get("TELEMETRY_FLUSH", "10"))        # сек. между записями на флеш
+TELEMETRY_MIN_INTERVAL  = float(os.environ.get("TELEMETRY_MIN_INTERVAL", "1"))  # не чаще отсчёта в сек. на канал
+TELEMETRY_SEGMENT_BYTES = int(os.environ.get("TELEMETRY_SEGMENT_BYTES", str(1024 * 1024)))
+TELEMETRY_MAX_BYTES     = int(os.environ.get("TELEMETRY_MAX_BYTES", str(64 * 1024 * 1024)))  # старые сегменты удаляются
+TELEMETRY_PRELOAD       = float(os.environ.get("TELEMETRY_PRELOAD", "3600"))    # сек. истории, поднимаемой в RAM при старте
+
+# Режим HTTP: "pool" — пул потоков + keep-alive (HTTP/1.1), "single" — старый однопоточный HTTP/1.0.
+HTTP_ENGINE       = os.environ.get("HTTP_ENGINE", "pool").lower()
+HTTP_WORKERS      = int(os.environ.get("HTTP_WORKERS", "16"))        # потоков-обработчиков в пуле
+HTTP_MAX_CONN     = int(os.environ.get("HTTP_MAX_CONN", "64"))       # открытых соединений (простаивающие не занимают потоков пула)
+HTTP_IDLE_TIMEOUT = float(os.environ.get("HTTP_IDLE_TIMEOUT", "10")) # сек. простоя keep-alive до закрытия
+
+# Многопроцессный режим (Linux): HTTP_PROCESSES > 1 — основной процесс держит UART, команды и парк,
+# HTTP обслуживают дочерние процессы на одном порту (SO_REUSEPORT); STATE — через общую память.
+HTTP_PROCESSES = int(os.environ.get("HTTP_PROCESSES", "1"))
+STATE_SHM_SIZE = int(os.environ.get("STATE_SHM_SIZE", str(256 * 1024)))  # байт под JSON состояния
+STATE_SHM_POLL = float(os.environ.get("STATE_SHM_POLL", "0.005"))         # сек. между проверками версии
+
+# SSE-поток /api/state/stream (только в режиме pool). После рукопожатия поток пула свободен:
+# события во все потоки пишет один поток-рассыльщик. Каждый поток — соединение из HTTP_MAX_CONN.
+SSE_MAX_CLIENTS = int(os.environ.get("SSE_MAX_CLIENTS", str(max(1, HTTP_MAX_CONN // 2))))
+SSE_HEARTBEAT   = float(os.environ.get("SSE_HEARTBEAT", "15"))    # сек. между ": ping"
+SSE_COALESCE    = float(os.environ.get("SSE_COALESCE", "0.02"))   # сек. на склейку пачки изменений
+
+# Термозащита: правила на каждом отсчёте temp_c (UART и FAKE_TEMP). Порог сброса = порог − THERMAL_HYST.
+# Модем выключается только при включённом в панели modem_off_temp.
+THERMAL_WARN   = float(os.environ.get("THERMAL_WARN", "75"))   # °C скользящего среднего → system=warn
+THERMAL_CRIT   = float(os.environ.get("THERMAL_CRIT", "85"))   # °C отсчёта → system=err и выключение модема
+THERMAL_HYST   = float(os.environ.get("THERMAL_HYST", "5"))    # °C
+THERMAL_RATE   = float(os.environ.get("THERMAL_RATE", "1.0"))  # °C/с роста по окну → warn (сброс — вдвое ниже)
+THERMAL_WINDOW = int(os.environ.get("THERMAL_WINDOW", "8"))    # отсчётов в скользящем окне
+THERMAL_RATE_SPAN = float(os.environ.get("THERMAL_RATE_SPAN", "5"))  # сек.: rate — не по интервалу короче
+
+# Сколько последних изменений STATE помнить для /api/state?since=N
+STATE_HISTORY = int(os.environ.get("STATE_HISTORY", "256"))
+
+# Журнал событий (GET /api/logs): записей в памяти и максимальная длина строки
+LOG_STORE_SIZE = int(os.environ.get("LOG_STORE_SIZE", "500"))
+LOG_MAX_LINE   = int(os.environ.get("LOG_MAX_LINE", "300"))
+
+# Логгер: очередь + фоновый писатель. LOG_FILE пуст — пишем в stderr, иначе в файл с ротацией по размеру
+LOG_LEVEL      = os.environ.get("LOG_LEVEL", "info").lower()      # debug|info|warn|error
+LOG_FORMAT     = os.environ.get("LOG_FORMAT", "text").lower()     # text (key=value) | json (строка JSON на запись)
+LOG_FILE       = os.environ.get("LOG_FILE", "")
+LOG_FILE_MAX   = int(os.environ.get("LOG_FILE_MAX", str(512 * 1024)))  # байт до ротации
+LOG_FILE_KEEP  = int(os.environ.get("LOG_FILE_KEEP", "3"))             # сколько старых файлов (.1 .. .N) хранить
+LOG_QUEUE      = int(os.environ.get("LOG_QUEUE", "10000"))             # переполнение — запись теряется и считается
+LOG_DUP_WINDOW = float(os.environ.get("LOG_DUP_WINDOW", "60"))         # сек.: одинаковая запись — не чаще раза за окно
+
+# Профилирование: спаны (iot_span_seconds в /metrics) и сэмплер стеков через /api/admin/profile
+PROFILE_SPANS       = os.environ.get("PROFILE_SPANS", "0") in ("1", "true", "True")  # включить спаны с запуска
+PROFILE_HZ          = int(os.environ.get("PROFILE_HZ", "100"))           # снимков стеков в секунду по умолчанию
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "300")) # сэмплер останавливается сам
+PROFILE_MAX_STACKS  = int(os.environ.get("PROFILE_MAX_STACKS", "20000")) # разных стеков в памяти, дальше — счётчик
+ADMIN_TOKEN         = os.environ.get("ADMIN_TOKEN", "")                   # задан — /api/admin/* только с X-Admin-Token
+
+# Кэш статики в RAM (файлы читаются с флеша один раз, gzip-версия готовится заранее)
+STATIC_CACHE_FILE_MAX = int(os.environ.get("STATIC_CACHE_FILE_MAX", str(256 * 1024)))  # крупнее — отдаём потоком с диска
+STATIC_CACHE_TOTAL    = int(os.environ.get("STATIC_CACHE_TOTAL", str(1024 * 1024)))    # общий лимит кэша
+STATIC_MAX_AGE        = int(os.environ.get("STATIC_MAX_AGE", "300"))  # сек. для css/картинок; HTML всегда перепроверяется
 
 # ================== СОСТОЯНИЕ ==================
-STATE_LOCK = threading.Lock()
+# Состояние хранится неизменяемыми снимками (copy-on-write): писатели под замком StateStore собирают
+# новую копию и подменяют ссылку, читатели берут текущий снимок без блокировок.
+# STATE — только начальное состояние (снимок версии 0); текущее — state_current().state.
 STATE = {
     "power": True,
     "wifi_on": True,
@@ -51,13 +136,995 @@ STATE = {
     "rf_cluster_polarization": "23/B, 28/B, 17/A",
     "wifi_password": "12345678",
     "ssid": "Orion",
-    "logs": ["событие прошло ", "модем подключен"],
+    "log_seq": 0,  # номер последней записи журнала; сами строки — GET /api/logs?after=
+    "thermal": {"avg": None, "rate": None, "active": []},  # термозащита: среднее, °C/с, сработавшие правила
     "last_update": None,
 }
 
+# BOOT_ID в ETag — чтобы после перезапуска сервера старые ETag не совпадали.
+BOOT_ID = format(int(time.time()), "x")
+
+def _clone(v):
+    """Копия JSON-значения (dict/list вложенные), без copy.deepcopy."""
+    if isinstance(v, dict):
+        return {k: _clone(x) for k, x in v.items()}
+    if isinstance(v, list):
+        return [_clone(x) for x in v]
+    return v
+
+def merge_diff(old:dict, new:dict) -> dict:
+    """JSON merge patch (RFC 7386), превращающий old в new. Списки заменяются целиком."""
+    patch = {}
+    for k, v in new.items():
+        if k not in old:
+            patch[k] = _clone(v)
+            continue
+        ov = old[k]
+        if isinstance(v, dict) and isinstance(ov, dict):
+            sub = merge_diff(ov, v)
+            if sub:
+                patch[k] = sub
+        elif v != ov or type(v) is not type(ov):
+            patch[k] = _clone(v)
+    for k in old:
+        if k not in new:
+            patch[k] = None
+    return patch
+
+def merge_compose(acc:dict, patch:dict) -> dict:
+    """Склеивает два патча подряд: acc, затем patch (удаления остаются как None)."""
+    for k, v in patch.items():
+        if isinstance(v, dict) and isinstance(acc.get(k), dict):
+            merge_compose(acc[k], v)
+        else:
+            acc[k] = _clone(v)
+    return acc
+
+class StateSnapshot:
+    """Неизменяемый снимок STATE. После публикации state не меняется; JSON считается один раз.
+    patches — последние STATE_HISTORY троек (версия-основа, версия, merge patch от основы).
+    Обычно основа = версия − 1; в HTTP-процессе между соседними записями могут быть пропуски."""
+    __slots__ = ("version", "state", "patches", "etag", "_body")
+
+    def __init__(self, version:int, state:dict, patches:tuple):
+        self.version = version
+        self.state = state
+        self.patches = patches
+        self.etag = f'"{BOOT_ID}-{version}"'
+        self._body = None
+
+    def body(self) -> bytes:
+        body = self._body
+        if body is None:
+            t0 = time.perf_counter() if SPANS else 0.0
+            # гонка двух читателей безвредна: оба получат одинаковые байты
+            body = self._body = json.dumps(self.state, ensure_ascii=False).encode("utf-8")
+            if t0:
+                span_end(M_SPAN["state_json"], t0)
+        return body
+
+class StateStore:
+    """Состояние одного устройства: цепочка снимков, свой замок писателей и своё ожидание смены версии."""
+
+    def __init__(self, state:dict):
+        self.lock = threading.Lock()        # только между писателями
+        self.cond = threading.Condition()   # будит SSE-потоки при смене версии (отдельно от lock)
+        self._snap = StateSnapshot(0, state, ())
+        self._writer = None                 # поток внутри write() и его рабочая копия
+        self._work = None
+
+    def current(self) -> StateSnapshot:
+        """Текущий снимок (без блокировок). Его state только для чтения."""
+        return self._snap
+
+    @contextmanager
+    def write(self):
+        """Изменение состояния: yield рабочей копии, на выходе — публикация нового снимка.
+        Версия растёт, только если что-то реально поменялось."""
+        t0 = time.perf_counter()
+        with self.lock:
+            t1 = time.perf_counter()
+            METRICS.observe(M_LOCK_WAIT, LOCK_BUCKETS, t1 - t0)
+            old = self._snap
+            work = _clone(old.state)
+            self._writer, self._work = threading.get_ident(), work
+            try:
+                yield work
+            except BaseException:
+                # писатель упал — полуизменённая копия выбрасывается, снимок остаётся прежним
+                self._writer = self._work = None
+                METRICS.observe(M_LOCK_HOLD, LOCK_BUCKETS, time.perf_counter() - t1)
+                raise
+            self._writer = self._work = None
+            patch = merge_diff(old.state, work)
+            if patch:
+                version = old.version + 1
+                patches = old.patches[-(STATE_HISTORY - 1):] if STATE_HISTORY > 1 else ()
+                self._snap = StateSnapshot(version, work, patches + ((old.version, version, patch),))
+                with self.cond:
+                    self.cond.notify_all()
+            METRICS.observe(M_LOCK_HOLD, LOCK_BUCKETS, time.perf_counter() - t1)
+
+    def update(self, fn):
+        """fn(рабочая копия) отдельной записью; если этот поток уже внутри write() — в его же копию
+        (иначе вложенный write() ждал бы сам себя)."""
+        if self._writer == threading.get_ident():
+            fn(self._work)
+            return
+        with self.write() as st:
+            fn(st)
+
+    def replace(self, version:int, state:dict, body:bytes=None):
+        """Принять готовое состояние с чужой версией (HTTP-процесс повторяет основной).
+        Пропущенные при опросе версии не рвут историю: дельта считается от последней увиденной."""
+        with self.lock:
+            old = self._snap
+            if version > old.version and STATE_HISTORY > 1:
+                patches = old.patches[-(STATE_HISTORY - 1):] + ((old.version, version, merge_diff(old.state, state)),)
+            else:
+                patches = ()
+            snap = StateSnapshot(version, state, patches)
+            snap._body = body
+            self._snap = snap
+            with self.cond:
+                self.cond.notify_all()
+
+    def snapshot(self):
+        """(version, body, etag) для текущего состояния; JSON собирается один раз на версию."""
+        snap = self._snap
+        return snap.version, snap.body(), snap.etag
+
+    def delta(self, since:int):
+        """Склеенный патч от версии since до текущей: (version, patch) или (version, None), если истории не хватает."""
+        snap = self._snap
+        version, patches = snap.version, snap.patches
+        if since == version:
+            return version, {}
+        if since > version or not patches or patches[0][0] > since:
+            return version, None
+        patch = {}
+        for base, v, p in patches:
+            if v > since:
+                if base < since:
+                    # since внутри пропуска (версия, которую этот процесс не видел) — промежуточного
+                    # состояния нет, дельта от base могла бы пропустить ключи, вернувшиеся к прежним значениям
+                    return version, None
+                merge_compose(patch, p)
+        return version, patch
+
+    def wait_change(self, version:int, timeout:float) -> int:
+        """Ждёт, пока версия отличается от version (или таймаут). Возвращает текущую версию."""
+        with self.cond:
+            self.cond.wait_for(lambda: self._snap.version != version, timeout)
+        return self._snap.version
+
+# Основное устройство (UART этого процесса). Функции ниже — его короткие имена.
+STATE_TEMPLATE = _clone(STATE)  # начальное состояние для устройств парка
+STATE_STORE = StateStore(STATE)
+STATE_LOCK = STATE_STORE.lock
+STATE_COND = STATE_STORE.cond
+
+def state_current() -> StateSnapshot:
+    return STATE_STORE.current()
+
+def state_write():
+    return STATE_STORE.write()
+
+def state_snapshot():
+    return STATE_STORE.snapshot()
+
+def state_delta(since:int):
+    return STATE_STORE.delta(since)
+
+def wait_state_change(version:int, timeout:float) -> int:
+    return STATE_STORE.wait_change(version, timeout)
+
+# ================== ИСТОРИЯ ТЕЛЕМЕТРИИ ==================
+class SampleRing:
+    """Кольцевой буфер (время, значение) на array: память фиксирована при создании.
+    Для каждых BLOCK отсчётов хранятся min/max/sum — запросы не проходят по всем точкам."""
+    BLOCK = 64
+
+    def __init__(self, size:int):
+        B = self.BLOCK
+        size = max(B, -(-size // B) * B)
+        self.size = size
+        self.ts = array("d", bytes(8 * size))
+        self.val = array("f", bytes(4 * size))
+        self.bmin = array("f", bytes(4 * (size // B)))
+        self.bmax = array("f", bytes(4 * (size // B)))
+        self.bsum = array("d", bytes(8 * (size // B)))
+        self.count = 0  # всего добавлено (индекс записи = count % size)
+        self.lock = threading.Lock()
+
+    def append(self, t:float, v:float):
+        with self.lock:
+            i = self.count % self.size
+            self.ts[i] = t
+            self.val[i] = v
+            v = self.val[i]  # как хранится (float32)
+            b, off = divmod(i, self.BLOCK)
+            if off == 0:
+                self.bmin[b] = self.bmax[b] = v
+                self.bsum[b] = v
+            else:
+                if v < self.bmin[b]: self.bmin[b] = v
+                if v > self.bmax[b]: self.bmax[b] = v
+                self.bsum[b] += v
+            self.count += 1
+
+    def _bisect(self, t:float, start:int, lo:int, hi:int, right:bool=True) -> int:
+        """Первый логический индекс в [lo, hi) с ts > t (right=False: ts >= t)."""
+        ts, size = self.ts, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            x = ts[(start + mid) % size]
+            if x < t or (right and x == t):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _agg(self, pa:int, pb:int, write_block:int):
+        """(min, max, sum) по физическому отрезку [pa, pb) без перехода через конец кольца."""
+        B, val = self.BLOCK, self.val
+        fb, lb = -(-pa // B), pb // B  # целые блоки [fb, lb)
+        if fb >= lb:
+            seg = val[pa:pb]
+            return min(seg), max(seg), sum(seg)
+        mins, maxs, sm = [], [], 0.0
+        for seg in (val[pa:fb * B], val[lb * B:pb]):
+            if seg:
+                mins.append(min(seg)); maxs.append(max(seg)); sm += sum(seg)
+        if fb <= write_block < lb:
+            # в блоке записи вперемешку новые и самые старые отсчёты — агрегат неполный
+            seg = val[write_block * B:(write_block + 1) * B]
+            mins.append(min(seg)); maxs.append(max(seg)); sm += sum(seg)
+            ranges = ((fb, write_block), (write_block + 1, lb))
+        else:
+            ranges = ((fb, lb),)
+        for a, b in ranges:
+            if a < b:
+                mins.append(min(self.bmin[a:b])); maxs.append(max(self.bmax[a:b])); sm += sum(self.bsum[a:b])
+        return min(mins), max(maxs), sm
+
+    def query(self, t0:float, t1:float, points:int) -> list:
+        """До points корзин по времени в [t0, t1]: [(t начала, min, max, mean, n), ...]."""
+        with self.lock:
+            size = self.size
+            n = min(self.count, size)
+            if not n:
+                return []
+            start = (self.count - n) % size
+            write_block = ((self.count - 1) % size) // self.BLOCK
+            lo = self._bisect(t0, start, 0, n, right=False)
+            hi = self._bisect(t1, start, lo, n)
+            if hi <= lo:
+                return []
+            tf = self.ts[(start + lo) % size]
+            width = (self.ts[(start + hi - 1) % size] - tf) / points or 1.0
+            out = []
+            a = lo
+            for k in range(1, points + 1):
+                b = hi if k == points else self._bisect(tf + width * k, start, a, hi)
+                if b > a:
+                    pa = (start + a) % size
+                    pb = pa + (b - a)
+                    if pb <= size:
+                        mn, mx, sm = self._agg(pa, pb, write_block)
+                    else:
+                        m1, x1, s1 = self._agg(pa, size, write_block)
+                        m2, x2, s2 = self._agg(0, pb - size, write_block)
+                        mn, mx, sm = min(m1, m2), max(x1, x2), s1 + s2
+                    out.append((self.ts[pa], mn, mx, sm / (b - a), b - a))
+                a = b
+            return out
+
+# Числовые каналы: путь в STATE → имя канала в /api/history
+HISTORY_CHANNELS = {
+    ("temp_c",): "temp_c",
+    ("angles", "tilt_current"): "angles.tilt_current",
+    ("angles", "tilt_required"): "angles.tilt_required",
+    ("angles", "rotate_current"): "angles.rotate_current",
+    ("angles", "rotate_required"): "angles.rotate_required",
+    ("rx", "progress"): "rx.progress",
+    ("tx", "progress"): "tx.progress",
+}
+HISTORY = {}  # имя канала -> SampleRing (создаётся при первом отсчёте)
+HISTORY_LOCK = threading.Lock()
+
+def history_ring(name:str) -> SampleRing:
+    ring = HISTORY.get(name)
+    if ring is None:
+        with HISTORY_LOCK:
+            ring = HISTORY.get(name)
+            if ring is None:
+                ring = HISTORY[name] = SampleRing(HISTORY_SIZE)
+    return ring
+
+def history_add(path:tuple, value, t:float):
+    """Отсчёт в историю (и в журнал на флеше, если включён), если путь — числовой канал."""
+    name = HISTORY_CHANNELS.get(path)
+    if name is None:
+        return
+    value = float(value)
+    history_ring(name).append(t, value)
+    if TELEMETRY is not None:
+        TELEMETRY.add(name, t, value)
+
+def history_channels() -> dict:
+    """Канал → число отсчётов в RAM."""
+    return {name: min(HISTORY[name].count, HISTORY[name].size) if name in HISTORY else 0
+            for name in HISTORY_CHANNELS.values()}
+
+def history_query(name:str, t0:float, t1:float, points:int):
+    """Прореженный ряд канала (колонками) или None, если канала нет."""
+    if name not in HISTORY_CHANNELS.values():
+        return None
+    ring = HISTORY.get(name)
+    rows = ring.query(t0, t1, points) if ring is not None else []
+    return {
+        "channel": name,
+        "from": t0, "to": t1,
+        "t":    [round(r[0], 3) for r in rows],
+        "min":  [round(r[1], 3) for r in rows],
+        "max":  [round(r[2], 3) for r in rows],
+        "mean": [round(r[3], 3) for r in rows],
+        "n":    [r[4] for r in rows],
+    }
+
+# ================== ЖУРНАЛ ТЕЛЕМЕТРИИ НА ФЛЕШЕ ==================
+# Сегменты "<seq>-<ms первого отсчёта>.tlm": заголовок SEG_HEADER + записи TLM_RECORD подряд.
+# Внутри сегмента время не убывает (при скачке часов назад начинается новый сегмент).
+TLM_MAGIC = b"IOTTLM01"
+SEG_HEADER = struct.Struct("<8sHH4x")   # magic, версия формата, размер записи
+TLM_RECORD = struct.Struct("<dHxxf")    # время (unix), id канала, значение — 16 байт
+TLM_INDEX_STRIDE = 4096                 # записей между точками разреженного индекса (64 КБ)
+
+# id каналов в файлах: только дописывать, не перенумеровывать
+TELEMETRY_CHANNEL_IDS = {
+    "temp_c": 1,
+    "angles.tilt_current": 2,
+    "angles.tilt_required": 3,
+    "angles.rotate_current": 4,
+    "angles.rotate_required": 5,
+    "rx.progress": 6,
+    "tx.progress": 7,
+}
+
+class TelemetryStore:
+    """Журнал отсчётов на флеше: пакетная запись не чаще TELEMETRY_FLUSH, чтение через mmap."""
+
+    def __init__(self, root:str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()        # буфер и прореживание
+        self._io_lock = threading.Lock()     # файлы сегментов
+        self._pending = bytearray()
+        self._last = {}                      # id канала -> время последнего принятого отсчёта
+        self._tail = 0.0                     # время последней записи в буфере: внутри сегмента время не убывает
+        self._index = {}                     # путь -> [время записи 0, STRIDE, 2*STRIDE, ...]
+        self._segments = []                  # [[seq, путь, первое время, последнее время]] по seq
+        for name in sorted(os.listdir(root)):
+            seq, _, rest = name.partition("-")
+            if not name.endswith(".tlm") or not seq.isdigit():
+                continue
+            path = os.path.join(root, name)
+            n = self._valid_records(path)
+            if n == 0:
+                os.remove(path)
+                continue
+            first, last = self._record_time(path, 0), self._record_time(path, n - 1)
+            self._segments.append([int(seq), path, first, last])
+        self._segments.sort()
+
+    # ---- запись ----
+    def add(self, name:str, t:float, value:float):
+        """Отсчёт в буфер (с прореживанием до TELEMETRY_MIN_INTERVAL на канал).
+        Отсчёт канала старше его последнего отбрасывается; отстающий от другого канала (потоки пишут
+        вперемешку) получает время последней записи — scan() рассчитывает на порядок по времени."""
+        ch = TELEMETRY_CHANNEL_IDS.get(name)
+        if ch is None:
+            return
+        with self._lock:
+            last = self._last.get(ch)
+            if last is not None and t - last < TELEMETRY_MIN_INTERVAL:
+                return
+            self._last[ch] = t
+            t = self._tail = max(t, self._tail)
+            self._pending += TLM_RECORD.pack(t, ch, value)
+
+    def flush(self):
+        """Буфер → текущий сегмент одной записью (+fsync); ротация и очистка старых сегментов."""
+        with self._lock:
+            data, self._pending = self._pending, bytearray()
+        if not data:
+            return
+        with self._io_lock:
+            seg = self._segments[-1] if self._segments else None
+            first_t = TLM_RECORD.unpack_from(data, 0)[0]
+            if (seg is None or os.path.getsize(seg[1]) + len(data) > TELEMETRY_SEGMENT_BYTES + SEG_HEADER.size
+                    or first_t < seg[3]):
+                seg = self._new_segment(first_t)
+            with open(seg[1], "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            seg[3] = max(seg[3], TLM_RECORD.unpack_from(data, len(data) - TLM_RECORD.size)[0])
+            self._trim()
+
+    def run(self):
+        while True:
+            time.sleep(TELEMETRY_FLUSH)
+            try:
+                self.flush()
+            except Exception as e:
+                log("telemetry flush err", level="error", err=e)
+
+    def _new_segment(self, first_t:float):
+        seq = self._segments[-1][0] + 1 if self._segments else 1
+        path = os.path.join(self.root, f"{seq:08d}-{int(first_t * 1000):013d}.tlm")
+        with open(path, "wb") as f:
+            f.write(SEG_HEADER.pack(TLM_MAGIC, 1, TLM_RECORD.size))
+        seg = [seq, path, first_t, first_t]
+        self._segments.append(seg)
+        return seg
+
+    def _trim(self):
+        total = sum(os.path.getsize(seg[1]) for seg in self._segments)
+        while total > TELEMETRY_MAX_BYTES and len(self._segments) > 1:
+            seg = self._segments.pop(0)
+            total -= os.path.getsize(seg[1])
+            os.remove(seg[1])
+            self._index.pop(seg[1], None)
+
+    # ---- чтение ----
+    @staticmethod
+    def _valid_records(path:str) -> int:
+        """Число целых записей; недописанный хвост (сбой питания) отрезается."""
+        with open(path, "r+b") as f:
+            head = f.read(SEG_HEADER.size)
+            if len(head) < SEG_HEADER.size or SEG_HEADER.unpack(head)[0] != TLM_MAGIC:
+                return 0
+            size = os.fstat(f.fileno()).st_size
+            n = (size - SEG_HEADER.size) // TLM_RECORD.size
+            if SEG_HEADER.size + n * TLM_RECORD.size != size:
+                f.truncate(SEG_HEADER.size + n * TLM_RECORD.size)
+            return n
+
+    @staticmethod
+    def _record_time(path:str, i:int) -> float:
+        with open(path, "rb") as f:
+            f.seek(SEG_HEADER.size + i * TLM_RECORD.size)
+            return TLM_RECORD.unpack(f.read(TLM_RECORD.size))[0]
+
+    def _sparse_index(self, path:str, mm, n:int) -> list:
+        """Времена каждой TLM_INDEX_STRIDE-й записи; достраивается по мере роста сегмента.
+        Кэш общий для потоков пула: достраивается копия, публикуется одним присваиванием."""
+        idx = self._index.get(path, [])
+        if len(idx) * TLM_INDEX_STRIDE < n:
+            idx = idx + [TLM_RECORD.unpack_from(mm, SEG_HEADER.size + i * TLM_RECORD.size)[0]
+                         for i in range(len(idx) * TLM_INDEX_STRIDE, n, TLM_INDEX_STRIDE)]
+            with self._io_lock:
+                # сегмент могла удалить очистка — его индекс больше не нужен
+                if any(seg[1] == path for seg in self._segments):
+                    self._index[path] = idx
+        return idx
+
+    def scan(self, t0:float, t1:float, fn):
+        """fn(время, id канала, значение) для записей в [t0, t1]; читаются только нужные страницы."""
+        with self._io_lock:
+            segments = [(seg[1], seg[2], seg[3]) for seg in self._segments if seg[3] >= t0 and seg[2] <= t1]
+        for path, _, _ in segments:
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                continue  # удалён очисткой
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                n = (size - SEG_HEADER.size) // TLM_RECORD.size
+                if n <= 0:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    idx = self._sparse_index(path, mm, n)
+                    start = max(0, bisect.bisect_left(idx, t0) - 1) * TLM_INDEX_STRIDE
+                    view = memoryview(mm)[SEG_HEADER.size + start * TLM_RECORD.size:
+                                          SEG_HEADER.size + n * TLM_RECORD.size]
+                    try:
+                        for t, ch, v in TLM_RECORD.iter_unpack(view):
+                            if t < t0:
+                                continue
+                            if t > t1:
+                                break
+                            fn(t, ch, v)
+                    finally:
+                        view.release()
+
+    def query(self, name:str, t0:float, t1:float, points:int):
+        """Ряд канала по корзинам (как history_query) или None, если канала нет."""
+        ch = TELEMETRY_CHANNEL_IDS.get(name)
+        if ch is None:
+            return None
+        width = (t1 - t0) / points or 1.0
+        acc = {}  # номер корзины -> [t первого, min, max, sum, n]
+
+        def put(t, c, v):
+            if c != ch:
+                return
+            k = min(points - 1, int((t - t0) / width))
+            b = acc.get(k)
+            if b is None:
+                acc[k] = [t, v, v, v, 1]
+            else:
+                if v < b[1]: b[1] = v
+                if v > b[2]: b[2] = v
+                b[3] += v
+                b[4] += 1
+
+        self.scan(t0, t1, put)
+        rows = [acc[k] for k in sorted(acc)]
+        return {
+            "channel": name,
+            "from": t0, "to": t1,
+            "t":    [round(r[0], 3) for r in rows],
+            "min":  [round(r[1], 3) for r in rows],
+            "max":  [round(r[2], 3) for r in rows],
+            "mean": [round(r[3] / r[4], 3) for r in rows],
+            "n":    [r[4] for r in rows],
+        }
+
+    def preload_history(self, since:float):
+        """Последние отсчёты с флеша → кольца истории в RAM (после перезапуска)."""
+        names = {ch: name for name, ch in TELEMETRY_CHANNEL_IDS.items()}
+
+        def put(t, ch, v):
+            if ch in names:
+                history_ring(names[ch]).append(t, v)
+
+        self.scan(since, float("inf"), put)
+
+TELEMETRY = None  # TelemetryStore, если задан TELEMETRY_DIR
+
 # ================== ЛОГГЕР ==================
-def log(*a):
-    print("[srv]", *a, file=sys.stderr, flush=True)
+LOG_TAG = "[srv]"  # HTTP-процессы многопроцессного режима — "[srv wN]"
+LOG_LEVELS = {"debug": 10, "info": 20, "warn": 30, "error": 40}
+
+def log(*a, level:str="info", **fields):
+    """Запись в лог: только кладёт кортеж в очередь (форматирование и вывод — в потоке LOGGER).
+    fields — структурированные поля: log("serial open failed", port=..., err=e)."""
+    if LOG_LEVELS.get(level, 20) >= LOGGER.level:
+        LOGGER.put((time.time(), level, LOG_TAG, a, fields))
+
+class Logger:
+    """Очередь записей и поток-писатель: пачка записей — одна запись в файл/stderr.
+    Одинаковая строка (уровень + текст) в файл/stderr чаще раза за LOG_DUP_WINDOW не пишется; по истечении
+    окна — та же строка с полем repeated=N. Журнал панели (LOGS) получает каждую запись: повторы там
+    схлопывает сам LogStore. Файл LOG_FILE ротируется по LOG_FILE_MAX: .1 … .LOG_FILE_KEEP."""
+
+    BATCH = 256
+
+    def __init__(self, level:str, maxsize:int):
+        self.level = LOG_LEVELS.get(level, LOG_LEVELS["info"])
+        self._q = queue.Queue(max(1, maxsize))
+        self._thread = None
+        self.forward = None     # HTTP-процесс: пачки уходят основному (у файла один писатель)
+        self._out = None
+        self._size = 0
+        self._recent = {}       # (уровень, метка, текст) → [время записи, подавлено с тех пор, поля]
+        self._next_sweep = 0.0
+
+    def put(self, rec):
+        try:
+            self._q.put_nowait(rec)
+        except queue.Full:
+            METRICS.inc(M_LOG_DROPPED)
+
+    def depth(self) -> int:
+        return self._q.qsize()
+
+    def reset(self):
+        """После fork: записи из очереди родителя выведет сам родитель."""
+        self._q = queue.Queue(self._q.maxsize)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="logger", daemon=True)
+        self._thread.start()
+
+    def close(self, timeout:float=2.0):
+        """Дописать очередь и остановить поток (при выходе)."""
+        if self._thread is None:
+            return
+        try:
+            self._q.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def run(self):
+        while True:
+            try:
+                batch = [self._q.get(timeout=1.0)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < self.BATCH:
+                try:
+                    batch.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._handle([r for r in batch if r is not None])
+            except Exception as e:
+                print(LOG_TAG, "logger err:", e, file=sys.stderr, flush=True)
+            if None in batch:
+                return
+
+    def _handle(self, batch:list):
+        now = time.time()
+        recs = []
+        for t, level, tag, args, fields in batch:
+            fields = {k: v if isinstance(v, (int, float, bool, type(None))) else str(v) for k, v in fields.items()}
+            recs.append((t, level, tag, " ".join(str(x) for x in args), fields))
+        if self.forward is not None and recs:
+            try:
+                # все записи, без подавления повторов: журнал панели ведёт основной процесс
+                self.forward([[t, level, tag, (text,), fields] for t, level, tag, text, fields in recs])
+                return
+            except Exception:
+                pass  # основной процесс недоступен — хотя бы в stderr
+        out = []
+        for t, level, tag, text, fields in recs:
+            if self.forward is None and level != "debug":
+                LOGS.add("srv", _log_text(text, fields))  # журнал панели — без отладочных строк
+            key = (level, tag, text)
+            seen = self._recent.get(key)
+            if seen is not None and t - seen[0] < LOG_DUP_WINDOW:
+                seen[1] += 1
+                METRICS.inc(M_LOG_SUPPRESSED)
+                continue
+            if seen is not None and seen[1]:
+                out.append((seen[0], level, tag, text, dict(seen[2], repeated=seen[1])))
+            self._recent[key] = [t, 0, fields]
+            out.append((t, level, tag, text, fields))
+        if now >= self._next_sweep:
+            # окно истекло, а строка больше не приходила — сообщаем, сколько раз она была подавлена
+            for key, seen in list(self._recent.items()):
+                if now - seen[0] >= LOG_DUP_WINDOW:
+                    del self._recent[key]
+                    if seen[1]:
+                        out.append((now, key[0], key[1], key[2], dict(seen[2], repeated=seen[1])))
+            self._next_sweep = now + 1.0
+        if out:
+            self._emit(out)
+
+    def _emit(self, recs:list):
+        lines = []
+        for t, level, tag, text, fields in recs:
+            if LOG_FORMAT == "json":
+                lines.append(json.dumps(dict(fields, t=round(t, 3), level=level, proc=tag.strip("[]"), msg=text),
+                                        ensure_ascii=False))
+            else:
+                stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+                lines.append(f"{stamp}.{int(t % 1 * 1000):03d} {level.upper():5} {tag} {_log_text(text, fields)}")
+        self._write("\n".join(lines) + "\n")
+
+    def _write(self, data:str):
+        if not LOG_FILE or self.forward is not None:
+            sys.stderr.write(data)
+            sys.stderr.flush()
+            return
+        raw = data.encode("utf-8")
+        try:
+            if self._out is None:
+                self._out = open(LOG_FILE, "ab")
+                self._size = self._out.tell()
+            if self._size and self._size + len(raw) > LOG_FILE_MAX:
+                self._rotate()
+            self._out.write(raw)
+            self._out.flush()
+            self._size += len(raw)
+        except OSError as e:
+            self._out = None
+            sys.stderr.write(f"{LOG_TAG} log file err: {e}\n{data}")
+            sys.stderr.flush()
+
+    def _rotate(self):
+        self._out.close()
+        self._out = None
+        if LOG_FILE_KEEP > 0:
+            for i in range(LOG_FILE_KEEP - 1, 0, -1):
+                if os.path.exists(f"{LOG_FILE}.{i}"):
+                    os.replace(f"{LOG_FILE}.{i}", f"{LOG_FILE}.{i + 1}")
+            os.replace(LOG_FILE, f"{LOG_FILE}.1")
+        else:
+            os.remove(LOG_FILE)
+        self._out = open(LOG_FILE, "ab")
+        self._size = 0
+
+def _log_text(text:str, fields:dict) -> str:
+    if not fields:
+        return text
+    return text + " " + " ".join(f"{k}={v}" for k, v in fields.items())
+
+LOGGER = Logger(LOG_LEVEL, LOG_QUEUE)
+
+# ---- Журнал событий ----
+# События сервера (log), команд и статусов UART с порядковым номером seq; последние LOG_STORE_SIZE в памяти.
+# В STATE — только log_seq: панель видит, что появилось новое, и забирает строки один раз
+# через GET /api/logs?after=<seq>&limit=.
+
+class LogStore:
+    """Ограниченный журнал с номерами записей. Повтор той же строки подряд — счётчик repeat, без новой записи."""
+
+    def __init__(self, size:int):
+        self._lock = threading.Lock()
+        self._entries = deque(maxlen=max(1, size))
+        self.seq = 0
+
+    def add(self, source:str, text:str) -> int:
+        text = text[:LOG_MAX_LINE]
+        now = time.time()
+        with self._lock:
+            last = self._entries[-1] if self._entries else None
+            if last is not None and last["text"] == text and last["source"] == source:
+                last["repeat"] += 1
+                last["t"] = round(now, 3)
+                return last["seq"]
+            self.seq += 1
+            self._entries.append({"seq": self.seq, "t": round(now, 3),
+                                  "time": time.strftime("%d.%m.%Y, %H:%M", time.localtime(now)),
+                                  "source": source, "text": text, "repeat": 1})
+            seq = self.seq
+        STATE_STORE.update(self._stamp)
+        return seq
+
+    def _stamp(self, st:dict):
+        # читаем seq под замком состояния: параллельные add не опубликуют номер назад
+        st["log_seq"] = self.seq
+
+    def query(self, after, limit:int) -> dict:
+        """Записи с seq > after по возрастанию (не больше limit); after=None — последние limit."""
+        with self._lock:
+            entries = self._entries
+            first = entries[0]["seq"] if entries else self.seq + 1
+            if after is None:
+                items = list(entries)[-limit:] if limit else []
+            else:
+                start = max(0, after - first + 1)
+                items = list(islice(entries, start, start + limit))
+            return {"seq": self.seq, "first": first,
+                    "truncated": after is not None and after < first - 1,  # часть записей уже вытеснена
+                    "more": bool(items) and items[-1]["seq"] < self.seq,
+                    "entries": [dict(e) for e in items]}
+
+LOGS = LogStore(LOG_STORE_SIZE)
+
+# ================== МЕТРИКИ ==================
+# Формат Prometheus на GET /metrics. Запись без блокировок: у каждого потока свой массив
+# array('d') со всеми значениями, счётчик — сложение в свой элемент; /metrics суммирует массивы.
+# Раскладка (метрика → смещение) фиксируется при импорте, до первой записи.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+LOCK_BUCKETS    = (1e-6, 1e-5, 1e-4, 0.001, 0.01, 0.1)
+SPAN_BUCKETS    = (1e-5, 5e-5, 1e-4, 5e-4, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+
+class Metrics:
+    """Реестр метрик: счётчики и гистограммы в потоковых массивах, gauge — функции на момент опроса."""
+
+    def __init__(self):
+        self._size = 0
+        self._families = []          # (имя, тип, help, label, [(значение метки, смещение)], границы)
+        self._gauges = []            # (имя, help, функция)
+        self._shards = []            # массивы всех потоков (list.append атомарен)
+        self._local = threading.local()
+        self._shared = None          # итоги процессов в общей памяти (многопроцессный режим)
+        self._slot = 0
+
+    def _family(self, name:str, kind:str, help:str, label, values, buckets=()):
+        if self._shards:
+            raise RuntimeError(f"{name}: метрики регистрируются до первой записи")
+        width = len(buckets) + 2 if kind == "histogram" else 1  # корзины, +Inf, сумма
+        offsets = []
+        for v in values:
+            offsets.append((v, self._size))
+            self._size += width
+        self._families.append((name, kind, help, label, offsets, buckets))
+        return {v: off for v, off in offsets}
+
+    def counter(self, name:str, help:str) -> int:
+        return self._family(name, "counter", help, None, (None,))[None]
+
+    def counter_vec(self, name:str, help:str, label:str, values) -> dict:
+        return self._family(name, "counter", help, label, values)
+
+    def histogram(self, name:str, help:str, buckets) -> int:
+        return self._family(name, "histogram", help, None, (None,), buckets)[None]
+
+    def histogram_vec(self, name:str, help:str, buckets, label:str, values) -> dict:
+        return self._family(name, "histogram", help, label, values, buckets)
+
+    def gauge(self, name:str, help:str, fn):
+        """Значение считается при опросе /metrics (можно регистрировать в любой момент)."""
+        self._gauges.append((name, help, fn))
+
+    def _shard(self) -> array:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = array("d", bytes(8 * self._size))
+            self._shards.append(shard)
+            return shard
+
+    def inc(self, off:int, n=1):
+        self._shard()[off] += n
+
+    def observe(self, off:int, buckets:tuple, value:float):
+        shard = self._shard()
+        shard[off + bisect.bisect_left(buckets, value)] += 1  # le — включительно
+        shard[off + len(buckets) + 1] += value
+
+    def share(self, slots:int):
+        """До fork: общая память под итоги процессов, по слоту на процесс (0 — основной)."""
+        self._shared = memoryview(mmap.mmap(-1, 8 * max(1, self._size) * slots)).cast("d")
+
+    def attach(self, slot:int):
+        self._slot = slot
+
+    def totals(self) -> list:
+        """Суммы по всем потокам этого процесса."""
+        total = [0.0] * self._size
+        for shard in list(self._shards):
+            for i, v in enumerate(shard):
+                if v:
+                    total[i] += v
+        return total
+
+    def publish(self):
+        """Итоги процесса → его слот (раз в секунду из metrics_publisher)."""
+        if self._shared is not None:
+            base = self._slot * self._size
+            self._shared[base:base + self._size] = array("d", self.totals())
+
+    def render(self) -> bytes:
+        total = self.totals()
+        if self._shared is not None:
+            # остальные процессы — по последней публикации (не старше секунды)
+            for slot in range(len(self._shared) // max(1, self._size)):
+                if slot != self._slot:
+                    base = slot * self._size
+                    for i, v in enumerate(self._shared[base:base + self._size]):
+                        if v:
+                            total[i] += v
+        fmt = lambda v: str(int(v)) if float(v).is_integer() else repr(float(v))
+        out = []
+        for name, kind, help, label, offsets, buckets in self._families:
+            out.append(f"# HELP {name} {help}\n# TYPE {name} {kind}\n")
+            for value, off in offsets:
+                lbl = f'{label}="{value}"' if label else ""
+                if kind == "counter":
+                    out.append(f"{name}{{{lbl}}} {fmt(total[off])}\n" if lbl else f"{name} {fmt(total[off])}\n")
+                    continue
+                sep = "," if lbl else ""
+                acc = 0.0
+                for i, le in enumerate(buckets + ("+Inf",)):
+                    acc += total[off + i]
+                    out.append(f'{name}_bucket{{{lbl}{sep}le="{le}"}} {fmt(acc)}\n')
+                suffix = f"{{{lbl}}}" if lbl else ""
+                out.append(f"{name}_sum{suffix} {fmt(total[off + len(buckets) + 1])}\n")
+                out.append(f"{name}_count{suffix} {fmt(acc)}\n")
+        for name, help, fn in self._gauges:
+            try:
+                value = fn()
+            except Exception:
+                continue
+            out.append(f"# HELP {name} {help}\n# TYPE {name} gauge\n{name} {fmt(value)}\n")
+        return "".join(out).encode("utf-8")
+
+METRICS = Metrics()
+
+# Гистограмма по маршрутам (M_HTTP_REQUESTS) регистрируется после таблицы ROUTER — см. раздел HTTP.
+METRIC_CODES = (200, 202, 206, 304, 400, 403, 404, 405, 408, 409, 411, 413, 416, 500, 503, "other")
+
+M_HTTP_CODES    = METRICS.counter_vec("iot_http_responses_total", "Ответы по коду статуса",
+                                      "code", METRIC_CODES)
+M_HTTP_BYTES    = METRICS.counter("iot_http_sent_bytes_total", "Отправлено байт (заголовки и тела)")
+M_HTTP_REJECTED = METRICS.counter("iot_http_rejected_total", "Соединения, отклонённые 503 по лимиту HTTP_MAX_CONN")
+M_SSE_STREAMS   = METRICS.counter("iot_sse_streams_total", "Открыто SSE-потоков /api/state/stream")
+M_SSE_CLOSED    = METRICS.counter("iot_sse_streams_closed_total", "Закрыто SSE-потоков (открытые = разность)")
+M_UART_BYTES    = METRICS.counter("iot_uart_read_bytes_total", "Прочитано байт из UART")
+M_UART_FRAMES   = METRICS.counter("iot_uart_frames_total", "Кадров UART (rate() — кадры/с)")
+M_UART_DROPPED  = METRICS.counter("iot_uart_dropped_bytes_total", "Непечатаемые байты, выброшенные при разборе")
+M_UART_JUNK     = METRICS.counter("iot_uart_junk_lines_total", "Строки UART не-JSON или длиннее UART_MAX_LINE")
+M_UART_JSON_ERR = METRICS.counter("iot_uart_json_errors_total", "Кадры, не разобранные json.loads")
+M_UART_FIELD_ERR = METRICS.counter("iot_uart_field_errors_total", "Значения полей, отвергнутые валидатором")
+M_SERIAL_OPENS  = METRICS.counter("iot_serial_opens_total", "Успешные открытия порта")
+M_SERIAL_FAILS  = METRICS.counter("iot_serial_open_failures_total", "Неудачные попытки открыть порт")
+M_SERIAL_LOST   = METRICS.counter("iot_serial_lost_total", "Порт пропал при чтении (закрыт для переоткрытия)")
+M_LOG_DROPPED   = METRICS.counter("iot_log_dropped_total", "Записи лога, потерянные при переполнении LOG_QUEUE")
+M_LOG_SUPPRESSED = METRICS.counter("iot_log_suppressed_total", "Повторы строки лога в окне LOG_DUP_WINDOW (не записаны)")
+M_LOCK_WAIT     = METRICS.histogram("iot_state_lock_wait_seconds", "Ожидание STATE_LOCK писателем", LOCK_BUCKETS)
+M_SPAN          = METRICS.histogram_vec("iot_span_seconds", "Время участков горячего пути (PROFILE_SPANS или /api/admin/spans)",
+                                        SPAN_BUCKETS, "span", ("http_send", "state_json", "uart_parse", "static_read"))
+M_THERMAL_TRIPS = METRICS.counter("iot_thermal_trips_total", "Срабатывания правил термозащиты")
+M_THERMAL_LAG   = METRICS.histogram("iot_thermal_reaction_seconds", "От чтения кадра до записи команды выключения в UART",
+                                    SPAN_BUCKETS)
+M_LOCK_HOLD     = METRICS.histogram("iot_state_lock_hold_seconds", "Удержание STATE_LOCK писателем", LOCK_BUCKETS)
+
+# ================== ПРОФИЛИРОВАНИЕ ==================
+# Спаны: на горячем пути — `t0 = time.perf_counter() if SPANS else 0.0` … `if t0: span_end(M_SPAN[имя], t0)`;
+# выключены — одна проверка глобального флага. Включаются PROFILE_SPANS или POST /api/admin/spans?on=1.
+SPANS = PROFILE_SPANS
+
+def span_end(off:int, t0:float):
+    METRICS.observe(off, SPAN_BUCKETS, time.perf_counter() - t0)
+
+class SamplingProfiler:
+    """Сэмплер стеков всех потоков процесса: hz раз в секунду sys._current_frames() → счётчик по стеку.
+    Результат — collapsed stacks ("a;b;c N" на строку) для flamegraph.pl / speedscope.
+    Не запущен — нет ни потока, ни затрат."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = None
+        self._counts = {}       # кортеж code-объектов (от листа к корню) → число снимков
+        self.hz = 0
+        self.samples = 0
+        self.overflow = 0       # снимки, не попавшие в счётчик из-за PROFILE_MAX_STACKS
+
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, hz:int, seconds:float) -> bool:
+        """False — уже запущен (отработавший по seconds, но не забранный stop() профиль сбрасывается)."""
+        with self._lock:
+            if self.running():
+                return False
+            self._counts, self.hz, self.samples, self.overflow = {}, hz, 0, 0
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name="profiler", daemon=True,
+                                            args=(self._stop, 1.0 / hz, time.monotonic() + seconds))
+            self._thread.start()
+            return True
+
+    def stop(self):
+        """Остановить и вернуть collapsed stacks; None — сэмплер не запускался."""
+        with self._lock:
+            if self._thread is None:
+                return None
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            return self.collapsed()
+
+    def _run(self, stop:threading.Event, period:float, deadline:float):
+        me = threading.get_ident()
+        counts = self._counts
+        while not stop.wait(period) and time.monotonic() < deadline:
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                key = tuple(codes)
+                n = counts.get(key)
+                if n is not None:
+                    counts[key] = n + 1
+                elif len(counts) < PROFILE_MAX_STACKS:
+                    counts[key] = 1
+                else:
+                    self.overflow += 1
+            self.samples += 1
+
+    def collapsed(self) -> bytes:
+        lines = {}
+        for codes, n in self._counts.items():
+            stack = ";".join(f"{os.path.basename(co.co_filename)}:{getattr(co, 'co_qualname', co.co_name)}"
+                             for co in reversed(codes))
+            lines[stack] = lines.get(stack, 0) + n  # разные code-объекты с одинаковыми именами
+        return "".join(f"{stack} {n}\n" for stack, n in sorted(lines.items())).encode("utf-8")
+
+PROFILER = SamplingProfiler()
 
 # ================== UART ==================
 SER = None
@@ -68,67 +1135,815 @@ def ensure_serial():
     global SER
     if serial is None:
         return False
+    with SER_LOCK:  # порт открывают и читатель, и писатель команд
+        try:
+            if SER is None or not SER.is_open:
+                SER = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=1)
+                METRICS.inc(M_SERIAL_OPENS)
+                log("UART opened", port=SERIAL_PORT, baud=BAUD_RATE)
+            return True
+        except Exception as e:
+            METRICS.inc(M_SERIAL_FAILS)
+            log("serial open failed", level="warn", port=SERIAL_PORT, err=e)
+            return False
+
+def close_serial():
+    """Закрыть порт после ошибки ввода-вывода — ensure_serial откроет его заново (USB/pty переподключили)."""
+    global SER
+    with SER_LOCK:
+        if SER is not None:
+            METRICS.inc(M_SERIAL_LOST)
+            try:
+                SER.close()
+            except Exception:
+                pass
+            SER = None
+
+# ---- Нарезка потока UART на кадры ----
+# Одна таблица для bytes.translate: \r → \n, всё кроме печатного ASCII, \t и \n — удаляется.
+_UART_MAP = bytes(range(256)).replace(b"\r", b"\n")
+_UART_DELETE = bytes(b for b in range(256) if not (32 <= b <= 126 or b in (9, 10, 13)))
+
+class UartFramer:
+    """Инкрементальный разбор: байты любыми кусками → очищенные строки-кадры JSON-объектов."""
+
+    def __init__(self, max_line:int=UART_MAX_LINE):
+        self.max_line = max_line
+        self.junk = 0           # отброшено строк (не JSON-объект или слишком длинные)
+        self.dropped = 0        # выброшено непечатаемых байт
+        self._buf = bytearray()
+
+    def feed(self, data:bytes) -> list:
+        """Добавляет байты, возвращает готовые кадры (bytes, начинаются с "{")."""
+        buf = self._buf
+        clean = data.translate(_UART_MAP, _UART_DELETE)
+        self.dropped += len(data) - len(clean)
+        buf += clean
+        end = buf.rfind(b"\n")
+        if end < 0:
+            if len(buf) > self.max_line:
+                # строка без конца — не копим бесконечно
+                self.junk += 1
+                del buf[:]
+            return []
+        chunk = bytes(buf[:end])
+        del buf[:end + 1]
+        frames = []
+        for line in chunk.split(b"\n"):
+            line = line.strip()
+            if not line:
+                continue
+            # дешёвый отсев мусора до json.loads
+            if line[:1] != b"{" or len(line) > self.max_line:
+                self.junk += 1
+                continue
+            frames.append(line)
+        return frames
+
+# ---- Протокол телеметрии: ключ кадра → (путь в STATE, валидатор) ----
+# Валидатор получает значение из JSON и возвращает значение для STATE или бросает ValueError/TypeError.
+STATUS3 = ("pending", "ok", "err")
+SYSTEM_STATES = ("pending", "ok", "warn", "err", "off")
+
+def _v_int(v):
+    if isinstance(v, bool):
+        raise TypeError("bool")
+    return int(float(v))
+
+def _v_float(v):
+    if isinstance(v, bool):
+        raise TypeError("bool")
+    return float(v)
+
+def _v_percent(v):
+    return max(0, min(100, _v_int(v)))
+
+def _v_bool(v):
+    if isinstance(v, bool) or v in (0, 1):
+        return bool(v)
+    raise ValueError(v)
+
+def _v_one_of(*allowed):
+    def check(v):
+        if v not in allowed:
+            raise ValueError(v)
+        return v
+    return check
+
+def _v_str(max_len:int):
+    def check(v):
+        if not isinstance(v, str) or len(v) > max_len:
+            raise ValueError(v)
+        return v
+    return check
+
+UART_FIELDS = {}
+
+def uart_field(key:str, path:str, validator):
+    """Регистрирует ключ кадра UART: значение → validator → STATE по пути "a.b"."""
+    UART_FIELDS[key] = (tuple(path.split(".")), validator)
+
+uart_field("TEMP",      "temp_c",                  _v_float)
+uart_field("TILT",      "angles.tilt_current",     _v_int)
+uart_field("TILT_REQ",  "angles.tilt_required",    _v_int)
+uart_field("ROT",       "angles.rotate_current",   _v_int)
+uart_field("ROT_REQ",   "angles.rotate_required",  _v_int)
+uart_field("LAT",       "coords.lat",              _v_float)
+uart_field("LNG",       "coords.lng",              _v_float)
+uart_field("COORDS",    "coords_status",           _v_one_of(*STATUS3))
+uart_field("GPS",       "gps_status",              _v_one_of(*STATUS3))
+uart_field("INET",      "inet_status",             _v_one_of(*STATUS3))
+uart_field("SYSTEM",    "system",                  _v_one_of(*SYSTEM_STATES))
+uart_field("RX",        "rx.progress",             _v_percent)
+uart_field("TX",        "tx.progress",             _v_percent)
+uart_field("ATTEMPT",   "attempt",                 _v_int)
+uart_field("BEAM",      "beam_number",             _v_int)
+uart_field("RFCP",      "rf_cluster_polarization", _v_str(64))
+uart_field("POWER",     "power",                   _v_bool)
+uart_field("WIFI",      "wifi_on",                 _v_bool)
+
+def uart_frame_updates(frame:bytes, out:list, ack=None, events:list=None) -> int:
+    """Разбирает кадр, добавляет в out пары (путь, значение). Возвращает число принятых полей.
+    ack(id, obj) — куда отдавать подтверждения команд (None — игнорировать);
+    events — куда складывать строки {"LOG": "..."} для журнала (None — игнорировать)."""
     try:
-        if SER is None or not SER.is_open:
-            SER = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=1)
-            log("UART opened:", SERIAL_PORT, BAUD_RATE)
+        obj = json.loads(frame)
+    except ValueError:
+        METRICS.inc(M_UART_JSON_ERR)
+        return 0
+    if not isinstance(obj, dict):
+        METRICS.inc(M_UART_JSON_ERR)
+        return 0
+    if ack is not None and "ACK" in obj:
+        # подтверждение команды: {"ACK": id, "OK": true} или {"ACK": id, "ERR": "..."}
+        ack(obj.get("ACK"), obj)
+    if events is not None and "LOG" in obj:
+        events.append(str(obj["LOG"]))
+    n = 0
+    for key, raw in obj.items():
+        field = UART_FIELDS.get(key)
+        if field is None:
+            continue
+        try:
+            out.append((field[0], field[1](raw)))
+            n += 1
+        except (ValueError, TypeError):
+            METRICS.inc(M_UART_FIELD_ERR)
+    return n
+
+# ================== ТЕРМОЗАЩИТА ==================
+# Правила считаются в пути приёма (apply_uart_updates / fake_temp_generator) на каждом отсчёте temp_c,
+# внутри той же записи состояния: system/power меняются в том же снимке, что и температура.
+# Сигналы за O(1) на отсчёт: temp — сам отсчёт, avg — скользящее среднее (бегущая сумма по окну),
+# rate — °C/с изменения среднего за последние THERMAL_RATE_SPAN сек. (пока данных меньше — 0). Правило включается на value >= on, выключается на value <= off.
+THERMAL_RULES = []
+SYSTEM_SEVERITY = {"warn": 1, "err": 2}
+
+def thermal_rule(name:str, signal:str, on:float, off:float, system:str, power_off:bool, text:str):
+    """Регистрирует правило: сигнал temp|avg|rate, пороги с гистерезисом, system=warn|err, выключить модем."""
+    THERMAL_RULES.append((name, signal, on, off, system, power_off, text))
+
+thermal_rule("overheat", "temp", THERMAL_CRIT, THERMAL_CRIT - THERMAL_HYST, "err",  True,  "Перегрев")
+thermal_rule("hot",      "avg",  THERMAL_WARN, THERMAL_WARN - THERMAL_HYST, "warn", False, "Высокая температура")
+thermal_rule("rising",   "rate", THERMAL_RATE, THERMAL_RATE / 2,            "warn", False, "Быстрый рост температуры")
+
+class ThermalGuard:
+    """Состояние правил термозащиты одного устройства (окно отсчётов и активные правила)."""
+
+    def __init__(self, rules:list, window:int):
+        self.rules = rules
+        self._win = deque(maxlen=max(1, window))  # (t, °C)
+        self._sum = 0.0
+        self._avgs = deque()    # (t, среднее) за THERMAL_RATE_SPAN: первым — самый поздний не моложе интервала
+        self.active = set()
+        self.system = None      # какой system выставила защита (вернём "ok", только если его не сменили)
+        self._off_at = None     # monotonic() последнего запроса выключения
+
+    def _want_off(self, st:dict) -> bool:
+        """Нужно ли (снова) просить выключение. power в st меняет только ACK модема: пока команда
+        в работе, не повторяем; после её таймаута со всеми повторами — просим ещё раз."""
+        if not st.get("modem_off_temp") or not st.get("power"):
+            return False
+        now = time.monotonic()
+        if self._off_at is not None and now - self._off_at < COMMAND_TIMEOUT * (1 + COMMAND_RETRIES) + 1:
+            return False
+        self._off_at = now
         return True
-    except Exception as e:
-        log(f"serial open failed ({SERIAL_PORT}):", e)
-        return False
+
+    def feed(self, st:dict, t:float, temp:float) -> list:
+        """Отсчёт → правка st (system, thermal). Возвращает действия после записи: [(текст, выключить)].
+        t — time.monotonic() самого отсчёта."""
+        win = self._win
+        if len(win) == win.maxlen:
+            self._sum -= win[0][1]
+        win.append((t, temp))
+        self._sum += temp
+        avg = self._sum / len(win)
+        # скорость — по сглаженному среднему и не быстрее чем за THERMAL_RATE_SPAN: пачка кадров или шум
+        # за доли секунды не дают «быстрого роста»
+        avgs = self._avgs
+        avgs.append((t, avg))
+        while len(avgs) > 1 and t - avgs[1][0] >= THERMAL_RATE_SPAN:
+            avgs.popleft()
+        dt = t - avgs[0][0]
+        rate = (avg - avgs[0][1]) / dt if dt >= THERMAL_RATE_SPAN else 0.0
+        signals = {"temp": temp, "avg": avg, "rate": rate}
+        actions = []
+        for name, signal, on, off, system, power_off, text in self.rules:
+            value = signals[signal]
+            if name not in self.active and value >= on:
+                self.active.add(name)
+                METRICS.inc(M_THERMAL_TRIPS)
+                off_now = power_off and self._want_off(st)
+                actions.append((f"{text}: {signal}={value:.1f} (порог {on:g})"
+                                + (" — выключаем модем" if off_now else ""), off_now))
+            elif name in self.active and value <= off:
+                self.active.discard(name)
+                actions.append((f"{text}: норма, {signal}={value:.1f}", False))
+            elif name in self.active and power_off and self._want_off(st):
+                # модем включили (или выключение не дошло), пока правило активно, — выключаем снова
+                actions.append((f"{text}: {signal}={value:.1f} — выключаем модем повторно", True))
+        level = max((r[4] for r in self.rules if r[0] in self.active), key=SYSTEM_SEVERITY.get, default=None)
+        if level is not None:
+            cur = st.get("system")
+            if cur == self.system or SYSTEM_SEVERITY.get(cur, 0) <= SYSTEM_SEVERITY[level]:
+                st["system"] = self.system = level
+        elif self.system is not None:
+            if st.get("system") == self.system:
+                st["system"] = "ok"
+            self.system = None
+        st["thermal"] = {"avg": round(signals["avg"], 2), "rate": round(signals["rate"], 3),
+                         "active": sorted(self.active)}
+        return actions
+
+THERMAL = ThermalGuard(THERMAL_RULES, THERMAL_WINDOW)
+
+def thermal_log(actions:list):
+    """Строки термозащиты в журнал — внутри записи состояния: log_seq попадает в тот же снимок."""
+    for text, _ in actions:
+        LOGS.add("thermal", text)
+
+def thermal_act(actions:list, t_read:float):
+    """После публикации снимка: срочная команда выключения (вперёд очереди UART).
+    Задержку реакции (t_read → запись в порт) учитывает CommandQueue._transmit."""
+    if any(off for _, off in actions):
+        COMMANDS.submit("power", False, urgent=True, t_read=t_read)
+
+# Смена этих статусов попадает в журнал событий
+LOGGED_STATUS_PATHS = {("system",), ("inet_status",), ("gps_status",), ("coords_status",)}
+
+def apply_uart_updates(updates:list, store:StateStore=None, t_read:float=None, events:list=None):
+    """Все поля пачки кадров — за один захват замка и один новый снимок (вместе с log_seq журнала).
+    store — состояние устройства парка; история, журнал и термозащита — только для основного.
+    t_read — perf_counter() чтения байт (для задержки реакции термозащиты); events — строки LOG из кадров."""
+    if not updates and not events:
+        return
+    changes, actions = [], []
+    now = time.time()
+    with (state_write() if store is None else store.write()) as st:
+        for path, value in updates:
+            node = st
+            for k in path[:-1]:
+                node = node[k]
+            if store is None and path in LOGGED_STATUS_PATHS and node.get(path[-1]) != value:
+                changes.append(f"{path[-1]}: {node.get(path[-1])} → {value}")
+            node[path[-1]] = value
+            if store is None and path == ("temp_c",):
+                actions += THERMAL.feed(st, time.monotonic(), value)  # метка — разбор этого кадра
+        if updates:
+            st["last_update"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        if store is None:
+            # журнал — в эту же запись: update() из LOGS.add правит текущую копию, а не публикует свою версию
+            thermal_log(actions)
+            for text in changes:
+                LOGS.add("uart", text)
+            for text in events or ():
+                LOGS.add("uart", text)
+    if store is not None:
+        return
+    thermal_act(actions, t_read if t_read is not None else time.perf_counter())
+    for path, value in updates:
+        history_add(path, value, now)
+
+def uart_ingest(framer:UartFramer, data:bytes, store:StateStore=None, ack=None):
+    """Кусок байт из порта → кадры → одна пачка обновлений состояния (с учётом в метриках)."""
+    t_read = time.perf_counter()
+    t0 = t_read if SPANS else 0.0
+    junk, dropped = framer.junk, framer.dropped
+    frames = framer.feed(data)
+    METRICS.inc(M_UART_BYTES, len(data))
+    METRICS.inc(M_UART_FRAMES, len(frames))
+    if framer.junk != junk:
+        METRICS.inc(M_UART_JUNK, framer.junk - junk)
+    if framer.dropped != dropped:
+        METRICS.inc(M_UART_DROPPED, framer.dropped - dropped)
+    updates = []
+    events = [] if store is None else None  # строки LOG — только в журнал основного устройства
+    for frame in frames:
+        uart_frame_updates(frame, updates, ack, events)
+    apply_uart_updates(updates, store, t_read, events)
+    if t0:
+        span_end(M_SPAN["uart_parse"], t0)
 
 def uart_reader():
-    """Читает строки JSON вида {"TEMP": число} и обновляет STATE."""
+    """Читает кадры JSON ({"TEMP": число, "TILT": ...}, см. UART_FIELDS) и обновляет STATE."""
     if serial is None:
-        log("pyserial не установлен — поток UART выключен")
+        log("pyserial не установлен — поток UART выключен", level="warn")
         return
+    framer = UartFramer()
     while True:
         try:
             if not ensure_serial():
                 time.sleep(1.0)
                 continue
-            raw = SER.readline()
-            if not raw:
-                continue
-            try:
-                text = raw.decode("utf-8", errors="ignore").strip()
-            except Exception:
-                continue
-            # фильтр печатных символов
-            text = "".join(ch for ch in text if ch in "\r\n\t" or (32 <= ord(ch) <= 126)).strip()
-            if not text:
-                continue
-            try:
-                obj = json.loads(text)
-            except Exception:
-                continue
-            if isinstance(obj, dict) and "TEMP" in obj:
-                try:
-                    val = float(obj["TEMP"])
-                except Exception:
-                    continue
-                with STATE_LOCK:
-                    STATE["temp_c"] = val
-                    STATE["last_update"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            # всё, что уже накопилось в драйвере, одним чтением; иначе ждём хотя бы байт (timeout порта)
+            data = SER.read(SER.in_waiting or 1)
+            if data:
+                uart_ingest(framer, data, ack=COMMANDS.ack)
+        except OSError as e:  # serial.SerialException — тоже OSError: устройство пропало
+            log("uart_reader port lost", level="warn", err=e)
+            close_serial()
+            time.sleep(0.5)
         except Exception as e:
-            log("uart_reader err:", e)
+            log("uart_reader err", level="error", err=e)
             # мягкая пауза, затем попытаемся снова
             time.sleep(0.5)
 
+# ================== КОМАНДЫ МОДЕМУ ==================
+# Имя команды → ключ STATE, который меняется после подтверждения (None — только действие).
+# "settings" — пачка настроек из /api/batch: значение = merge patch для STATE.
+# В порт уходит строка {"ID": n, "CMD": "POWER", "VAL": ...}, модем отвечает {"ACK": n, "OK": true}.
+COMMAND_SPECS = {
+    "power":         "power",
+    "off_temp":      "modem_off_temp",
+    "wifi":          "wifi_on",
+    "ssid":          "ssid",
+    "wifi_password": "wifi_password",
+    "retarget":      None,
+    "settings":      None,
+}
+
+# ---- /api/batch: операции → один merge patch ----
+def _op_switch(v):
+    if isinstance(v, bool):
+        return v
+    if isinstance(v, str) and v.lower() in ("on", "off"):
+        return v.lower() == "on"
+    raise ValueError("value must be on|off")
+
+def _op_text(max_len:int):
+    def check(v):
+        if not isinstance(v, str) or len(v) > max_len:
+            raise ValueError(f"value must be a string up to {max_len} chars")
+        return v
+    return check
+
+def _op_coord(v, limit:float) -> float:
+    v = _v_float(v)
+    if not -limit <= v <= limit:
+        raise ValueError(f"out of range ±{limit}")
+    return v
+
+# op → (ключ STATE, проверка значения); coords разбирается отдельно (два поля)
+BATCH_OPS = {
+    "power":         ("power", _op_switch),
+    "off_temp":      ("modem_off_temp", _op_switch),
+    "wifi":          ("wifi_on", _op_switch),
+    "ssid":          ("ssid", _op_text(32)),
+    "wifi_password": ("wifi_password", _op_text(64)),
+}
+
+def parse_batch(ops) -> tuple:
+    """Проверяет все операции сразу: (patch, []) или (None, [ошибки с индексами])."""
+    if isinstance(ops, dict):
+        ops = ops.get("ops")
+    if not isinstance(ops, list) or not ops:
+        return None, [{"index": None, "error": "expected {\"ops\": [...]} with at least one op"}]
+    patch, errors = {}, []
+    for i, op in enumerate(ops):
+        name = op.get("op") if isinstance(op, dict) else None
+        try:
+            if name == "coords":
+                patch["coords"] = {"lat": _op_coord(op.get("lat"), 90), "lng": _op_coord(op.get("lng"), 180)}
+            elif name in BATCH_OPS:
+                key, check = BATCH_OPS[name]
+                patch[key] = check(op.get("value"))
+            else:
+                raise ValueError(f"unknown op {name!r}")
+        except (ValueError, TypeError) as e:
+            errors.append({"index": i, "op": name, "error": str(e)})
+    return (None, errors) if errors else (patch, [])
+
+class CommandQueue:
+    """Очередь команд в UART: один поток-писатель, ожидание ACK по ID, таймауты и повторы.
+    Повторная команда того же типа, ещё не ушедшая в порт, сливается с ожидающей.
+    Срочная команда (urgent, термозащита) встаёт в голову очереди и прерывает ожидание ACK текущей:
+    обычная команда того же типа отменяется ("superseded"), другая — возвращается в очередь следом."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = deque()         # команды в очереди (ещё не отправлены); срочные — в голове
+        self._done = OrderedDict()      # id -> команда (в работе и завершённые), для статуса
+        self._next_id = 1
+        self._waiting = None            # команда, ждущая ACK
+        self._current = None            # команда, которую сейчас обслуживает run()
+        self._preempt = False           # в голове очереди срочная команда — текущее ожидание прервать
+        self._t_read = {}               # id срочной команды -> perf_counter() кадра, вызвавшего её
+
+    def submit(self, name:str, value=None, urgent:bool=False, t_read:float=None) -> dict:
+        """Ставит команду в очередь (не блокирует). Возвращает её статус."""
+        if urgent:
+            return self._submit_urgent(name, value, t_read)
+        with self._cond:
+            for cmd in self._pending:
+                if cmd["cmd"] == name:
+                    if isinstance(value, dict) and isinstance(cmd["value"], dict):
+                        merge_compose(cmd["value"], value)
+                    else:
+                        cmd["value"] = value
+                    cmd["merged"] += 1
+                    return _clone(cmd)
+            cmd = {"id": self._next_id, "cmd": name, "value": value, "status": "queued",
+                   "created": time.time(), "sent": None, "done": None,
+                   "attempts": 0, "merged": 0, "error": None}
+            self._next_id += 1
+            self._pending.append(cmd)
+            self._remember(cmd)
+            self._cond.notify_all()
+            return _clone(cmd)
+
+    def _submit_urgent(self, name:str, value, t_read:float) -> dict:
+        superseded = []
+        with self._cond:
+            cur = self._current
+            if cur is not None and cur.get("urgent") and cur["cmd"] == name and cur["value"] == value:
+                return _clone(cur)  # такая же срочная уже уходит в порт
+            for cmd in list(self._pending):
+                if cmd["cmd"] != name:
+                    continue
+                if cmd.get("urgent"):
+                    cmd["value"] = value
+                    cmd["merged"] += 1
+                    return _clone(cmd)
+                self._pending.remove(cmd)
+                self._supersede(cmd)
+                superseded.append(cmd)
+            cmd = {"id": self._next_id, "cmd": name, "value": value, "status": "queued",
+                   "created": time.time(), "sent": None, "done": None,
+                   "attempts": 0, "merged": 0, "error": None, "urgent": True}
+            self._next_id += 1
+            # за срочными, что уже в голове, но перед обычными
+            i = 0
+            while i < len(self._pending) and self._pending[i].get("urgent"):
+                i += 1
+            self._pending.insert(i, cmd)
+            if t_read is not None:
+                self._t_read[cmd["id"]] = t_read
+            self._remember(cmd)
+            if cur is not None and not cur.get("urgent"):
+                self._preempt = True
+            self._cond.notify_all()
+            status = _clone(cmd)
+        for old in superseded:
+            LOGS.add("cmd", self._describe(old))
+        return status
+
+    def _supersede(self, cmd:dict):
+        """Под _cond: обычная команда отменена срочной того же типа."""
+        cmd["status"] = "superseded"
+        cmd["done"] = time.time()
+
+    def _requeue(self, cmd:dict) -> bool:
+        """Под _cond: прерванная срочной команда — сразу за срочными.
+        False — отменена, потому что срочная того же типа."""
+        if self._waiting is cmd:
+            self._waiting = None
+        if any(c.get("urgent") and c["cmd"] == cmd["cmd"] for c in self._pending):
+            self._supersede(cmd)
+            return False
+        cmd["status"] = "queued"
+        i = 0
+        while i < len(self._pending) and self._pending[i].get("urgent"):
+            i += 1
+        self._pending.insert(i, cmd)
+        return True
+
+    def status(self, cmd_id:int):
+        with self._cond:
+            cmd = self._done.get(cmd_id)
+            return _clone(cmd) if cmd is not None else None
+
+    def depth(self) -> int:
+        """Команд в очереди (не считая ждущей ACK)."""
+        return len(self._pending)
+
+    def recent(self) -> list:
+        with self._cond:
+            return [_clone(c) for c in self._done.values()]
+
+    def ack(self, cmd_id, obj:dict):
+        """Вызывается из uart_reader при кадре {"ACK": id, ...}."""
+        with self._cond:
+            cmd = self._waiting
+            if cmd is None or cmd["id"] != cmd_id:
+                return  # запоздавший ACK уже закрытой команды
+            if obj.get("OK", "ERR" not in obj) is True:
+                cmd["status"] = "ok"
+            else:
+                cmd["status"] = "error"
+                cmd["error"] = str(obj.get("ERR", "rejected"))
+            cmd["done"] = time.time()
+            self._waiting = None
+            self._cond.notify_all()
+        LOGS.add("cmd", self._describe(cmd))
+        if cmd["status"] == "ok":
+            key = COMMAND_SPECS.get(cmd["cmd"])
+            if cmd["cmd"] == "settings":
+                # вся пачка — одним снимком и одной версией
+                with state_write() as st:
+                    merge_compose(st, cmd["value"])
+            elif key is not None:
+                with state_write() as st:
+                    st[key] = cmd["value"]
+
+    def _remember(self, cmd:dict):
+        self._done[cmd["id"]] = cmd
+        while len(self._done) > COMMAND_KEEP:
+            self._done.popitem(last=False)
+
+    def _transmit(self, cmd:dict) -> bool:
+        line = json.dumps({"ID": cmd["id"], "CMD": cmd["cmd"].upper(), "VAL": cmd["value"]},
+                          ensure_ascii=False).encode("utf-8") + b"\n"
+        if ensure_serial():
+            with SER_LOCK:
+                SER.write(line)
+            self._sent_lag(cmd)
+            return True
+        if FAKE_TEMP:
+            # стенд без модема: эмулируем мгновенное подтверждение
+            self._sent_lag(cmd)
+            self.ack(cmd["id"], {"OK": True})
+            return True
+        return False
+
+    def _sent_lag(self, cmd:dict):
+        # термозащита: от чтения кадра до первой записи команды в порт
+        t_read = self._t_read.pop(cmd["id"], None) if cmd.get("urgent") else None
+        if t_read is not None:
+            METRICS.observe(M_THERMAL_LAG, SPAN_BUCKETS, time.perf_counter() - t_read)
+
+    def run(self):
+        """Поток-писатель: по одной команде, следующая — после ACK или таймаута."""
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                cmd = self._pending.popleft()
+                cmd["status"] = "sending"
+                self._current = cmd
+                self._preempt = False
+            preempted = lambda: self._preempt and not cmd.get("urgent")
+            requeued = None
+            for _ in range(1 + COMMAND_RETRIES):
+                with self._cond:
+                    if preempted():
+                        requeued = self._requeue(cmd)
+                        break
+                    cmd["attempts"] += 1
+                    cmd["sent"] = time.time()
+                    cmd["status"] = "sent"
+                    self._waiting = cmd
+                try:
+                    sent = self._transmit(cmd)
+                except Exception as e:
+                    log("command write err", level="error", err=e)
+                    sent = False
+                with self._cond:
+                    if sent:
+                        self._cond.wait_for(lambda: self._waiting is not cmd or preempted(), COMMAND_TIMEOUT)
+                    if self._waiting is not cmd:
+                        break  # ACK получен
+                    if preempted():
+                        requeued = self._requeue(cmd)  # срочная команда — вперёд; эта повторится после неё
+                        break
+                    self._waiting = None
+                    cmd["status"] = "sending"
+                    if not sent:
+                        self._cond.wait_for(preempted, COMMAND_TIMEOUT)
+            else:
+                with self._cond:
+                    cmd["status"] = "timeout" if sent else "offline"
+                    cmd["done"] = time.time()
+                LOGS.add("cmd", self._describe(cmd))
+            with self._cond:
+                self._current = None
+            if requeued is False:
+                LOGS.add("cmd", self._describe(cmd))
+
+    @staticmethod
+    def _describe(cmd:dict) -> str:
+        """Строка журнала о завершении команды (без значения: там бывает пароль)."""
+        result = {"ok": "выполнена", "timeout": "нет подтверждения модема",
+                  "offline": "порт недоступен", "superseded": "отменена срочной командой"}.get(cmd["status"], f"ошибка: {cmd['error']}")
+        return f"команда {cmd['cmd']} #{cmd['id']}: {result}"
+
+COMMANDS = CommandQueue()
+
 def fake_temp_generator():
     """Эмулятор температуры, если нет реального UART."""
     t = 45.0
     direction = +0.5
     while True:
-        with STATE_LOCK:
-            # лёгкая пила в пределах 35..65
+        t_read = time.perf_counter()
+        with state_write() as st:
+            # лёгкая пила в пределах 35..FAKE_TEMP_MAX; отсчёт проходит ту же термозащиту, что кадр UART
             t += direction
-            if t > 65: direction = -0.5
+            if t > FAKE_TEMP_MAX: direction = -0.5
             if t < 35: direction = +0.5
-            STATE["temp_c"] = round(t, 2)
-            STATE["last_update"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            st["temp_c"] = round(t, 2)
+            st["last_update"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            actions = THERMAL.feed(st, time.monotonic(), st["temp_c"])
+            thermal_log(actions)
+        thermal_act(actions, t_read)
+        history_add(("temp_c",), round(t, 2), time.time())
         time.sleep(FAKE_PERIOD)
 
+# ================== ПАРК УСТРОЙСТВ ==================
+# Шлюз на несколько постов: у каждого устройства своё состояние (StateStore) и своя версия.
+# Основное устройство процесса — "local" (UART выше, команды, история). Остальные обслуживает
+# один поток fleet_loop: порты — через selectors, симуляторы — по куче сроков, без потока на устройство.
+
+class Device:
+    """Устройство парка: источник — последовательный порт (port), симулятор или основной UART."""
+
+    def __init__(self, dev_id:str, kind:str, port:str=None, baud:int=BAUD_RATE, store:StateStore=None):
+        self.id = dev_id
+        self.kind = kind                # "local" | "uart" | "sim"
+        self.port = port
+        self.baud = baud
+        self.store = store or StateStore(_clone(STATE_TEMPLATE))
+        self.framer = UartFramer()
+        self.ser = None
+        self.retry_at = 0.0             # когда снова пробовать открыть порт
+        self.sim_t = 45.0               # пила температуры симулятора
+        self.sim_step = 0.5
+
+    def online(self) -> bool:
+        if self.kind == "sim":
+            return True
+        if self.kind == "local":
+            return FAKE_TEMP or (SER is not None and SER.is_open)
+        return self.ser is not None
+
+    def info(self) -> dict:
+        snap = self.store.current()
+        return {"id": self.id, "kind": self.kind, "port": self.port if self.kind != "sim" else None,
+                "online": self.online(), "version": snap.version,
+                "last_update": snap.state.get("last_update")}
+
+    def sim_tick(self):
+        t = self.sim_t + self.sim_step
+        if t > 65: self.sim_step = -0.5
+        if t < 35: self.sim_step = +0.5
+        self.sim_t = t
+        with self.store.write() as st:
+            st["temp_c"] = round(t, 2)
+            st["last_update"] = time.strftime("%Y-%m-%d %H:%M:%S")
+
+    def open(self, sel) -> bool:
+        try:
+            self.ser = serial.Serial(self.port, self.baud, timeout=0)  # без ожидания: читаем по готовности
+            sel.register(self.ser.fileno(), selectors.EVENT_READ, self)
+        except Exception as e:
+            METRICS.inc(M_SERIAL_FAILS)
+            log(f"fleet {self.id}: open failed", level="warn", port=self.port, err=e)
+            self.close(sel)
+            return False
+        METRICS.inc(M_SERIAL_OPENS)
+        log(f"fleet {self.id}: UART opened", port=self.port, baud=self.baud)
+        return True
+
+    def close(self, sel):
+        if self.ser is not None:
+            try:
+                sel.unregister(self.ser.fileno())
+            except Exception:
+                pass
+            try:
+                self.ser.close()
+            except Exception:
+                pass
+        self.ser = None
+        self.retry_at = time.monotonic() + 1.0
+
+    def read(self, sel):
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except OSError as e:
+            METRICS.inc(M_SERIAL_LOST)
+            log(f"fleet {self.id}: port lost", level="warn", err=e)
+            return self.close(sel)
+        if data:
+            uart_ingest(self.framer, data, self.store)
+
+DEVICES = OrderedDict()   # id → Device, порядок — как в конфигурации
+DEVICES["local"] = Device("local", "local", SERIAL_PORT, store=STATE_STORE)
+
+def device_list() -> list:
+    return [d.info() for d in DEVICES.values()]
+
+def device_store(dev_id:str):
+    """StateStore устройства или None."""
+    dev = DEVICES.get(dev_id)
+    return dev.store if dev is not None else None
+
+def parse_fleet(spec:str, sims:int) -> list:
+    """FLEET="post1=/dev/ttyUSB0,post2=/dev/ttyUSB1@57600" + FLEET_SIM симуляторов → [Device]."""
+    devices = []
+    for item in filter(None, (x.strip() for x in spec.split(","))):
+        dev_id, sep, port = item.partition("=")
+        port, _, baud = port.partition("@")
+        if not sep or not dev_id or not port or (baud and not baud.isdigit()):
+            log(f"FLEET: пропуск записи {item!r} (ожидается id=порт[@скорость])", level="warn")
+            continue
+        devices.append(Device(dev_id, "uart", port, int(baud) if baud else BAUD_RATE))
+    width = len(str(sims))
+    for i in range(sims):
+        dev = Device(f"sim-{i + 1:0{width}d}", "sim")
+        dev.sim_t = 35.0 + (i * 7) % 30  # разнести пилы, чтобы устройства не шли в ногу
+        devices.append(dev)
+    return devices
+
+def fleet_loop(devices:list):
+    """Один поток на весь парк: чтение готовых портов и тики симуляторов."""
+    sel = selectors.DefaultSelector()
+    ports = [d for d in devices if d.kind == "uart"]
+    sims = [d for d in devices if d.kind == "sim"]
+    # сроки тиков равномерно по периоду — нагрузка не пачками
+    now = time.monotonic()
+    due = [(now + FAKE_PERIOD * i / max(1, len(sims)), i) for i in range(len(sims))]
+    heapq.heapify(due)
+    while True:
+        try:
+            now = time.monotonic()
+            for d in ports:
+                if d.ser is None and now >= d.retry_at:
+                    d.open(sel)
+            timeout = 1.0
+            if due:
+                timeout = max(0.0, min(timeout, due[0][0] - now))
+            if sel.get_map():
+                for key, _ in sel.select(timeout):
+                    key.data.read(sel)
+            else:
+                time.sleep(timeout)
+            now = time.monotonic()
+            while due and due[0][0] <= now:
+                t, i = heapq.heappop(due)
+                sims[i].sim_tick()
+                heapq.heappush(due, (max(t + FAKE_PERIOD, now), i))
+        except Exception as e:
+            log("fleet_loop err", level="error", err=e)
+            time.sleep(0.5)
+
+def start_fleet():
+    """Регистрирует устройства из FLEET/FLEET_SIM и запускает fleet_loop (если есть кого обслуживать)."""
+    devices = parse_fleet(FLEET, FLEET_SIM)
+    for d in devices:
+        if d.id in DEVICES:
+            log(f"FLEET: повтор id {d.id!r} — пропуск", level="warn")
+            continue
+        DEVICES[d.id] = d
+    devices = [d for d in DEVICES.values() if d.kind != "local"]
+    if not devices:
+        return
+    if serial is None and any(d.kind == "uart" for d in devices):
+        log("pyserial отсутствует — порты парка не будут открыты", level="warn")
+        devices = [d for d in devices if d.kind == "sim"]
+    threading.Thread(target=fleet_loop, args=(devices,), name="fleet", daemon=True).start()
+    log(f"fleet: {len(devices)} устройств ({sum(d.kind == 'sim' for d in devices)} симуляторов)")
+
+# Сводка по всем устройствам: несколько ключевых полей; JSON пересобирается, только когда сменилась
+# версия хотя бы одного устройства.
+SUMMARY_FIELDS = ("temp_c", "system", "power", "inet_status", "gps_status", "last_update")
+_SUMMARY_CACHE = (None, b"")
+
+def devices_summary() -> bytes:
+    global _SUMMARY_CACHE
+    snaps = [(d, d.store.current()) for d in DEVICES.values()]
+    key = tuple(snap.version for _, snap in snaps)
+    cached = _SUMMARY_CACHE
+    if cached[0] == key:
+        return cached[1]
+    devices = {}
+    for d, snap in snaps:
+        row = devices[d.id] = {"version": snap.version, "online": d.online()}
+        for f in SUMMARY_FIELDS:
+            row[f] = snap.state.get(f)
+    body = json.dumps({"count": len(devices), "devices": devices}, ensure_ascii=False).encode("utf-8")
+    _SUMMARY_CACHE = (key, body)
+    return body
+
 # ================== HTTP ==================
 def safe_local_path(url_path: str) -> str:
     """Безопасное сопоставление URL → локальный путь в DOC_ROOT."""
@@ -140,149 +1955,1370 @@ def safe_local_path(url_path: str) -> str:
         return ""  # попытка выхода из каталога
     return full
 
+def etag_matches(header:str, etag:str) -> bool:
+    """Проверка If-None-Match: список ETag через запятую или "*"."""
+    if not header:
+        return False
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == "*" or tag == etag:
+            return True
+    return False
+
+SSE_SLOTS = threading.BoundedSemaphore(max(1, SSE_MAX_CLIENTS))
+
+class SSEClient:
+    __slots__ = ("sock", "sent", "buf", "last", "release")
+
+    def __init__(self, sock, sent, release):
+        self.sock = sock
+        self.sent = sent          # версия STATE, уже отправленная клиенту
+        self.buf = bytearray()    # не влезло в сокет
+        self.last = time.monotonic()
+        self.release = release    # закрыть сокет (сервер возвращает место в HTTP_MAX_CONN)
+
+class SSEBroadcaster:
+    """Открытые SSE-потоки: один поток ждёт новую версию STATE (wait_change) и пишет событие во все сокеты.
+    Сокеты неблокирующие: медленный клиент копит свой буфер (до MAX_BACKLOG, потом отключается),
+    ушедший клиент виден в селекторе как EOF — замечаем за CHECK сек., а не на следующем пинге."""
+    MAX_BACKLOG = 256 * 1024
+    CHECK = 1.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._new = []
+        self._thread = None
+
+    @staticmethod
+    def event(body:bytes, etag:str) -> bytes:
+        return b"id: " + etag.strip('"').encode("ascii") + b"\nevent: state\ndata: " + body + b"\n\n"
+
+    def add(self, sock, sent, release):
+        """Принять сокет после заголовков ответа; sent — версия, которую клиент уже видел."""
+        sock.setblocking(False)
+        with self._lock:
+            self._new.append(SSEClient(sock, sent, release))
+            # поток стартует по первому клиенту: в многопроцессном режиме — в каждом HTTP-процессе
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sse", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        sel = selectors.DefaultSelector()
+        clients = set()
+        version, event = None, b""
+        while True:
+            with self._lock:
+                new, self._new = self._new, []
+            for c in new:
+                clients.add(c)
+                sel.register(c.sock, selectors.EVENT_READ, c)
+            v, body, etag = state_snapshot()
+            if v != version:
+                version = v
+                event = self.event(body, etag)
+            now = time.monotonic()
+            for c in clients:
+                if c.sent != version:
+                    c.buf += event
+                    c.sent = version
+                    METRICS.inc(M_HTTP_BYTES, len(event))
+                elif not c.buf and now - c.last >= SSE_HEARTBEAT:
+                    c.buf += b": ping\n\n"
+                if c.buf:
+                    self._flush(c)
+            dead = [c for c in clients if c.buf is None or len(c.buf) > self.MAX_BACKLOG]
+            for key, _ in sel.select(0):
+                c = key.data
+                try:
+                    if c.sock.recv(4096):
+                        continue  # клиент SSE ничего не шлёт — игнорируем
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    pass
+                dead.append(c)
+            for c in set(dead):
+                clients.discard(c)
+                sel.unregister(c.sock)
+                METRICS.inc(M_SSE_CLOSED)
+                SSE_SLOTS.release()
+                c.release(c.sock)
+            # ждём новую версию; пока есть недописанные буферы — недолго
+            timeout = 0.05 if any(c.buf for c in clients) else self.CHECK
+            if wait_state_change(version, timeout) != version and SSE_COALESCE > 0:
+                # пачку изменений (UART-кадры подряд) отдаём одним событием
+                time.sleep(SSE_COALESCE)
+
+    @staticmethod
+    def _flush(c:SSEClient):
+        try:
+            n = c.sock.send(c.buf)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            c.buf = None  # клиент ушёл
+            return
+        del c.buf[:n]
+        c.last = time.monotonic()
+
+SSE = SSEBroadcaster()
+
+# ---- Кэш статики ----
+GZIP_TYPES = ("text/", "application/javascript", "application/json", "application/xml",
+              "image/svg+xml", "image/x-icon", "image/vnd.microsoft.icon")
+
+class StaticAsset:
+    """Закэшированный файл: содержимое, gzip-вариант и заголовки валидации."""
+    __slots__ = ("key", "mtime", "data", "gz", "etag", "etag_gz", "last_modified")
+
+    def __init__(self, st, data:bytes, gz:bytes):
+        self.key = (st.st_mtime_ns, st.st_size)
+        self.mtime = int(st.st_mtime)
+        self.data = data
+        self.gz = gz
+        self.etag, self.last_modified = file_validators(st)
+        self.etag_gz = self.etag[:-1] + '-gz"'
+
+def file_validators(st):
+    """(ETag, Last-Modified) файла по размеру и mtime."""
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"', formatdate(st.st_mtime, usegmt=True)
+
+_STATIC = OrderedDict()  # путь -> StaticAsset, порядок = давность использования
+_STATIC_BYTES = 0
+_STATIC_LOCK = threading.Lock()
+
+def _gzip(data:bytes) -> bytes:
+    # wbits=31 — формат gzip; через zlib, чтобы mtime в заголовке был 0 (стабильный результат)
+    z = zlib.compressobj(9, zlib.DEFLATED, 31)
+    return z.compress(data) + z.flush()
+
+def load_static(local:str, ctype:str, st=None):
+    """StaticAsset из кэша (перечитывается при смене mtime/size). None — файл слишком большой для кэша."""
+    global _STATIC_BYTES
+    st = st or os.stat(local)
+    key = (st.st_mtime_ns, st.st_size)
+    with _STATIC_LOCK:
+        asset = _STATIC.get(local)
+        if asset is not None and asset.key == key:
+            _STATIC.move_to_end(local)
+            return asset
+    if st.st_size > STATIC_CACHE_FILE_MAX:
+        return None
+    t0 = time.perf_counter() if SPANS else 0.0
+    with open(local, "rb") as f:
+        data = f.read()
+    gz = None
+    if ctype.startswith(GZIP_TYPES) and len(data) > 512:
+        gz = _gzip(data)
+        if len(gz) > len(data) * 0.9:
+            gz = None  # сжатие почти ничего не даёт
+    if t0:
+        span_end(M_SPAN["static_read"], t0)
+    asset = StaticAsset(st, data, gz)
+    with _STATIC_LOCK:
+        old = _STATIC.pop(local, None)
+        if old is not None:
+            _STATIC_BYTES -= len(old.data) + len(old.gz or b"")
+        _STATIC[local] = asset
+        _STATIC_BYTES += len(data) + len(gz or b"")
+        while _STATIC_BYTES > STATIC_CACHE_TOTAL and len(_STATIC) > 1:
+            _, old = _STATIC.popitem(last=False)
+            _STATIC_BYTES -= len(old.data) + len(old.gz or b"")
+    return asset
+
+def accepts_gzip(header:str) -> bool:
+    """Accept-Encoding разрешает gzip (и не с q=0)."""
+    if not header:
+        return False
+    for part in header.split(","):
+        name, _, params = part.partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            for param in params.split(";"):
+                k, _, v = param.strip().partition("=")
+                if k == "q":
+                    try:
+                        return float(v) > 0
+                    except ValueError:
+                        return False
+            return True
+    return False
+
+def parse_range(header:str, size:int):
+    """Один диапазон "bytes=a-b" / "a-" / "-n" → (start, end) включительно.
+    None — заголовок игнорируем (мусор или несколько диапазонов), False — диапазон вне файла (416)."""
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            n = int(last)
+            if n == 0:
+                return False
+            start, end = max(0, size - n), size - 1
+    except ValueError:
+        return None
+    if start > end and first and last:
+        return None
+    if start >= size:
+        return False
+    return start, min(end, size - 1)
+
+def not_modified_since(header:str, mtime:int) -> bool:
+    """If-Modified-Since не раньше mtime файла."""
+    try:
+        return int(parsedate_to_datetime(header).timestamp()) >= mtime
+    except Exception:
+        return False
+
+# ---- Маршрутизатор ----
+# Таблица собирается один раз при импорте (декораторы @ROUTER.route на методах Handler).
+# Точные пути — один поиск в dict по (метод, путь); пути с параметрами ("/api/commands/<int:id>") —
+# dict по (метод, литеральный префикс до первого параметра): стоимость не растёт с числом маршрутов.
+
+class Request:
+    """Разобранный запрос: путь, параметры пути, query (разбирается один раз, по требованию), тело."""
+    __slots__ = ("path", "raw_query", "params", "body", "_query")
+
+    def __init__(self, path:str, raw_query:str, params:dict, body:bytes=b""):
+        self.path = path
+        self.raw_query = raw_query
+        self.params = params
+        self.body = body
+        self._query = None
+
+    @property
+    def query(self) -> dict:
+        """Имя → первое значение (как q.get(name, [..])[0] у parse_qs)."""
+        q = self._query
+        if q is None:
+            q = self._query = {}
+            for k, v in parse_qsl(self.raw_query):
+                q.setdefault(k, v)
+        return q
+
+    def arg(self, name:str, default:str="") -> str:
+        return self.query.get(name, default)
+
+class Route:
+    __slots__ = ("method", "pattern", "fn", "prefix", "parts", "metric")
+
+    def __init__(self, method:str, pattern:str, fn):
+        self.method = method
+        self.pattern = pattern
+        self.fn = fn
+        self.metric = None  # смещение в M_HTTP_REQUESTS
+        i = pattern.find("<")
+        if i < 0:
+            self.prefix, self.parts = pattern, None
+            return
+        self.prefix = pattern[:pattern.rfind("/", 0, i) + 1]
+        parts = []
+        for seg in pattern[len(self.prefix):].split("/"):
+            if seg.startswith("<") and seg.endswith(">"):
+                conv, _, name = seg[1:-1].rpartition(":")
+                if conv not in ("", "int"):
+                    raise ValueError(f"{pattern}: неизвестный тип {conv}")
+                parts.append((name, conv == "int"))
+            else:
+                parts.append(seg)
+        self.parts = tuple(parts)
+
+    def match(self, path:str):
+        """dict параметров или None."""
+        segs = path[len(self.prefix):].split("/")
+        if len(segs) != len(self.parts):
+            return None
+        params = {}
+        for seg, part in zip(segs, self.parts):
+            if isinstance(part, str):
+                if seg != part:
+                    return None
+            elif part[1]:
+                if not seg.isdigit():
+                    return None
+                params[part[0]] = int(seg)
+            elif seg:
+                params[part[0]] = seg
+            else:
+                return None
+        return params
+
+class Router:
+    """Маршруты по методу и пути."""
+
+    def __init__(self):
+        self.routes = []
+        self._exact = {}     # (метод, путь) → Route
+        self._param = {}     # (метод, префикс) → [Route]
+        self._methods = {}   # путь или префикс → {методы} (для 405 и Allow)
+
+    def route(self, method:str, pattern:str):
+        """Декоратор: fn(handler, req) обслуживает method + pattern."""
+        def register(fn):
+            r = Route(method, pattern, fn)
+            if r.parts is None:
+                if (method, pattern) in self._exact:
+                    raise ValueError(f"маршрут {method} {pattern} уже есть")
+                self._exact[(method, pattern)] = r
+            else:
+                self._param.setdefault((method, r.prefix), []).append(r)
+            self._methods.setdefault(pattern, set()).add(method)
+            self.routes.append(r)
+            return fn
+        return register
+
+    def match(self, method:str, path:str):
+        """(Route, params) или (None, None)."""
+        r = self._exact.get((method, path))
+        if r is not None:
+            return r, None
+        if self._param:
+            # префиксы пути справа налево: "/api/commands/5" → "/api/commands/", "/api/", "/"
+            i = len(path)
+            while i > 0:
+                i = path.rfind("/", 0, i)
+                if i < 0:
+                    break
+                for r in self._param.get((method, path[:i + 1]), ()):
+                    params = r.match(path)
+                    if params is not None:
+                        return r, params
+        return None, None
+
+    def allowed(self, path:str) -> str:
+        """Методы точного пути (для 405), "" — пути нет."""
+        return ", ".join(sorted(self._methods.get(path, ())))
+
+    def labels(self) -> tuple:
+        return tuple(dict.fromkeys(r.pattern for r in self.routes))
+
+ROUTER = Router()
+
 class Handler(BaseHTTPRequestHandler):
     server_version = "HLK7688AHTTP/1.1"
+    allow_streams = False  # долгие SSE-соединения заблокировали бы однопоточный сервер
+    _m_route = None        # смещение гистограммы маршрута текущего запроса (Route.metric)
+    _m_t0 = 0.0
+
+    def handle_one_request(self):
+        self._m_route = None
+        super().handle_one_request()
+        if self._m_route is not None:
+            METRICS.observe(self._m_route, LATENCY_BUCKETS, time.perf_counter() - self._m_t0)
+
+    def log_message(self, format, *args):
+        # журнал доступа и ошибки разбора — в очередь логгера (видны при LOG_LEVEL=debug);
+        # при уровне выше debug строку даже не собираем
+        if LOG_LEVELS["debug"] >= LOGGER.level:
+            log(format % args, level="debug", client=self.client_address[0])
+
+    def send_response(self, code, message=None):
+        METRICS.inc(M_HTTP_CODES.get(code, M_HTTP_CODES["other"]))
+        super().send_response(code, message)
 
-    def _send(self, code:int, ctype:str, body:bytes=b""):
+    def flush_headers(self):
+        n = 0
+        for chunk in getattr(self, "_headers_buffer", ()):
+            n += len(chunk)
+        METRICS.inc(M_HTTP_BYTES, n)
+        super().flush_headers()
+
+    def _send(self, code:int, ctype:str, body:bytes=b"", headers:dict=None):
+        t0 = time.perf_counter() if SPANS else 0.0
         self.send_response(code)
         self.send_header("Content-Type", ctype)
-        # не кэшируем JSON/HTML в отладке
-        self.send_header("Cache-Control", "no-store")
+        headers = headers or {}
+        if "Cache-Control" not in headers:
+            # не кэшируем JSON/HTML в отладке
+            self.send_header("Cache-Control", "no-store")
+        for k, v in headers.items():
+            self.send_header(k, v)
         self.send_header("Content-Length", str(len(body)))
         self.end_headers()
         if body:
+            METRICS.inc(M_HTTP_BYTES, len(body))
             self.wfile.write(body)
+        if t0:
+            span_end(M_SPAN["http_send"], t0)
 
-    def do_GET(self):
+    def _send_not_modified(self, headers:dict):
+        """304 без тела (Content-Length не шлём — он описывал бы полный ответ)."""
+        self.send_response(304)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+
+    def _not_modified(self, etag:str, mtime:int) -> bool:
+        """Условный GET: If-None-Match важнее If-Modified-Since."""
+        inm = self.headers.get("If-None-Match")
+        if inm is not None:
+            return etag_matches(inm, etag)
+        return not_modified_since(self.headers.get("If-Modified-Since"), mtime)
+
+    @staticmethod
+    def _static_cache_control(ctype:str) -> str:
+        # HTML перепроверяем всегда (ответ 304 дешёвый), остальное можно держать STATIC_MAX_AGE
+        return "no-cache" if ctype.startswith("text/html") else f"max-age={STATIC_MAX_AGE}"
+
+    def _send_file(self, local:str, ctype:str):
+        """Статика из кэша: gzip по Accept-Encoding, 304 по If-None-Match / If-Modified-Since.
+        Большие файлы и запросы с Range идут через _send_file_stream."""
+        st = os.stat(local)
+        asset = None if self.headers.get("Range") else load_static(local, ctype, st)
+        if asset is None:
+            return self._send_file_stream(local, ctype, st)
+        use_gz = asset.gz is not None and accepts_gzip(self.headers.get("Accept-Encoding"))
+        etag = asset.etag_gz if use_gz else asset.etag
+        headers = {
+            "ETag": etag,
+            "Last-Modified": asset.last_modified,
+            "Cache-Control": self._static_cache_control(ctype),
+            "Accept-Ranges": "bytes",
+        }
+        if asset.gz is not None:
+            headers["Vary"] = "Accept-Encoding"
+        if self._not_modified(etag, asset.mtime):
+            return self._send_not_modified(headers)
+        if use_gz:
+            headers["Content-Encoding"] = "gzip"
+            return self._send(200, ctype, asset.gz, headers)
+        return self._send(200, ctype, asset.data, headers)
+
+    def _send_file_stream(self, local:str, ctype:str, st):
+        """Файл с диска кусками (sendfile, где есть): память не зависит от размера; Range/If-Range → 206."""
+        etag, last_modified = file_validators(st)
+        headers = {
+            "ETag": etag,
+            "Last-Modified": last_modified,
+            "Cache-Control": self._static_cache_control(ctype),
+            "Accept-Ranges": "bytes",
+        }
+        if self._not_modified(etag, int(st.st_mtime)):
+            return self._send_not_modified(headers)
+
+        size = st.st_size
+        code, start, length = 200, 0, size
+        rng = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        # If-Range: диапазон только если файл не менялся, иначе отдаём целиком
+        if rng and (if_range is None or if_range.strip() in (etag, last_modified)):
+            r = parse_range(rng, size)
+            if r is False:
+                headers["Content-Range"] = f"bytes */{size}"
+                return self._send(416, "text/plain; charset=utf-8", b"Range not satisfiable", headers)
+            if r is not None:
+                code, start, length = 206, r[0], r[1] - r[0] + 1
+                headers["Content-Range"] = f"bytes {r[0]}-{r[1]}/{size}"
+
+        with open(local, "rb") as f:
+            self.send_response(code)
+            self.send_header("Content-Type", ctype)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(length))
+            self.end_headers()
+            if length:
+                METRICS.inc(M_HTTP_BYTES, length)
+                # socket.sendfile: os.sendfile без копирования в Python, иначе цикл send блоками
+                self.connection.sendfile(f, start, length)
+
+    def _send_command(self, name:str, value=None):
+        """Команда в очередь UART; ответ сразу — 202 с id для опроса статуса."""
+        cmd = COMMANDS.submit(name, value)
+        body = json.dumps(cmd, ensure_ascii=False).encode("utf-8")
+        return self._send(202, "application/json; charset=utf-8", body,
+                          {"Location": f"/api/commands/{cmd['id']}"})
+
+    @ROUTER.route("GET", "/api/state/stream")
+    def _stream_state(self, req:Request):
+        """SSE: событие "state" на каждую новую версию STATE, пинги между ними.
+        Здесь только заголовки; дальше сокет ведёт SSE, поток пула свободен."""
+        if not self.allow_streams or not SSE_SLOTS.acquire(blocking=False):
+            return self._send(503, "text/plain; charset=utf-8", b"Stream unavailable")
+        self._m_route = None  # длительность потока — не латентность
+        METRICS.inc(M_SSE_STREAMS)
         try:
-            u = urlparse(self.path)
-            path = u.path
-
-            # --- API
-            if path == "/api/state":
-                with STATE_LOCK:
-                    body = json.dumps(STATE, ensure_ascii=False).encode("utf-8")
-                return self._send(200, "application/json; charset=utf-8", body)
-            if self.path == "/update.html":
-                log(">>> Отправить команду на включение WIFI <<<")
-
-            if self.path == "/update_esp":
-                  # Отправляем редирект на новый URL
-                self.send_response(200)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                self.wfile.write(b"http://192.168.0.194/update")
-
-                return 
-
-            if path == "/api/modem/power":
-                q = parse_qs(u.query)
-                state_val = (q.get("state", [""])[0] or "").lower()
-                with STATE_LOCK:
-                    if   state_val == "on":  STATE["power"] = True
-                    elif state_val == "off": STATE["power"] = False
-                return self._send(204, "text/plain; charset=utf-8")
-
-            if path == "/api/modem/off-temp":
-                q = parse_qs(u.query)
-                state_val = (q.get("state", [""])[0] or "").lower()
-                with STATE_LOCK:
-                    if   state_val == "on":  STATE["modem_off_temp"] = True
-                    elif state_val == "off": STATE["modem_off_temp"] = False
-                return self._send(204, "text/plain; charset=utf-8")
-
-            if path == "/api/wifi":
-                q = parse_qs(u.query)
-                state_val = (q.get("state", [""])[0] or "").lower()
-                with STATE_LOCK:
-                    if   state_val == "on":  STATE["wifi_on"] = True
-                    elif state_val == "off": STATE["wifi_on"] = False
-                return self._send(204, "text/plain; charset=utf-8")
-
-            if path == "/api/wifi/password":
-                q = parse_qs(u.query)
-                password_val = q.get("password", [""])[0]
-                with STATE_LOCK:
-                    STATE["wifi_password"] = password_val
-                return self._send(204, "text/plain; charset=utf-8")
-
-            if path == "/api/wifi/ssid":
-                q = parse_qs(u.query)
-                ssid_val = q.get("ssid", [""])[0]
-                with STATE_LOCK:
-                    STATE["ssid"] = ssid_val
-                return self._send(204, "text/plain; charset=utf-8")
-
-            if path == "/api/antenna/retarget":
-                log("Повторное наведение инициировано")
-                return self._send(204, "text/plain; charset=utf-8")
-
-            # --- Корень: строго index.html
-            if path == "/":
-                index_path = os.path.join(DOC_ROOT, INDEX_FILE)
-                if os.path.isfile(index_path):
-                    with open(index_path, "rb") as f:
-                        data = f.read()
-                    return self._send(200, "text/html; charset=utf-8", data)
-                return self._send(404, "text/plain; charset=utf-8", b"index.html not found")
-
-            # --- Раздача статики
-            local = safe_local_path(path)
-            if local and os.path.isfile(local):
-                ctype, _ = mimetypes.guess_type(local)
-                if not ctype:
-                    ctype = "application/octet-stream"
-                with open(local, "rb") as f:
-                    data = f.read()
-                return self._send(200, ctype, data)
-
-            # --- Остальное
-            return self._send(404, "text/plain; charset=utf-8", b"Not found")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")  # без Content-Length поток заканчивается закрытием
+            self.end_headers()
+            self.wfile.write(b"retry: 2000\n\n")
+            version, body, etag = state_snapshot()
+            # Last-Event-ID совпадает с текущей версией — клиент уже всё видел
+            if self.headers.get("Last-Event-ID") != etag.strip('"'):
+                event = SSE.event(body, etag)
+                METRICS.inc(M_HTTP_BYTES, len(event))
+                self.wfile.write(event)
+            self.wfile.flush()
+        except OSError:
+            METRICS.inc(M_SSE_CLOSED)
+            SSE_SLOTS.release()
+            return  # клиент ушёл
+        self.detached = True
+        SSE.add(self.connection, version, self.server.release)
+
+    # ---- Диспетчер ----
+    def _dispatch(self, method:str, body:bytes=b""):
+        try:
+            path, _, raw_query = self.path.partition("?")
+            route, params = ROUTER.match(method, path)
+            if route is None:
+                # не API — статика (только GET)
+                if method == "GET":
+                    self._m_route = M_HTTP_REQUESTS["other" if path.startswith("/api/") else "static"]
+                    self._m_t0 = time.perf_counter()
+                    return self._send_static(path)
+                allow = ROUTER.allowed(path)
+                if allow:
+                    return self._send(405, "text/plain; charset=utf-8", b"Method not allowed", {"Allow": allow})
+                return self._send(404, "text/plain; charset=utf-8", b"Not found")
+            self._m_route = route.metric
+            self._m_t0 = time.perf_counter()
+            return route.fn(self, Request(path, raw_query, params, body))
 
         except Exception as e:
-            log("GET err:", e)
+            log(f"{method} err", level="error", err=e)
             try: self._send(500, "text/plain; charset=utf-8", b"Server error")
             except: pass
 
+    def _dispatch_with_body(self, method:str):
+        if "Transfer-Encoding" in self.headers:
+            # chunked не разбираем: непрочитанное тело на keep-alive ушло бы в разбор следующего запроса
+            if "Content-Length" in self.headers:
+                return self._send(400, "text/plain; charset=utf-8", b"Bad request", {"Connection": "close"})
+            return self._send(411, "text/plain; charset=utf-8", b"Length required", {"Connection": "close"})
+        body = self._read_body()
+        if body is None:
+            return self._send(413, "text/plain; charset=utf-8", b"Body too large")
+        return self._dispatch(method, body)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
     def do_POST(self):
+        self._dispatch_with_body("POST")
+
+    def do_PUT(self):
+        self._dispatch_with_body("PUT")
+
+    def _read_body(self, limit:int=16384):
+        """Тело запроса по Content-Length. None — слишком большое (соединение закрываем)."""
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0 or length > limit:
+            self.close_connection = True
+            return None
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, obj, code:int=200):
+        return self._send(code, "application/json; charset=utf-8",
+                          json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+
+    # ---- Состояние ----
+    @ROUTER.route("GET", "/api/state")
+    def _api_state(self, req:Request):
+        if "since=" in req.raw_query:
+            self._m_route = M_HTTP_REQUESTS["/api/state?since"]
+        return self._send_state(req, STATE_STORE)
+
+    def _send_state(self, req:Request, store:StateStore):
+        """Состояние устройства: ?since=N&boot= — дельта (merge patch), иначе полный JSON с ETag."""
+        if "since=" in req.raw_query:
+            since = req.arg("since")
+            if since.isdigit() and req.arg("boot", BOOT_ID) == BOOT_ID:
+                version, patch = store.delta(int(since))
+                if patch is not None:
+                    return self._send_json({"version": version, "boot": BOOT_ID, "patch": patch})
+            # история ушла дальше (или другой запуск сервера) — полный снимок
+            version, body, _ = store.snapshot()
+            body = (b'{"version": ' + str(version).encode("ascii") +
+                    b', "boot": "' + BOOT_ID.encode("ascii") + b'", "state": ' + body + b'}')
+            return self._send(200, "application/json; charset=utf-8", body)
+        _, body, etag = store.snapshot()
+        # no-cache: браузер хранит ответ, но каждый раз перепроверяет по ETag
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag_matches(self.headers.get("If-None-Match"), etag):
+            return self._send_not_modified(headers)
+        return self._send(200, "application/json; charset=utf-8", body, headers)
+
+    # ---- Журнал событий ----
+    @ROUTER.route("GET", "/api/logs")
+    def _api_logs(self, req:Request):
+        after, limit = req.arg("after"), req.arg("limit", "100")
+        if (after and not after.isdigit()) or not limit.isdigit():
+            return self._send(400, "text/plain; charset=utf-8", b"Bad after/limit")
+        return self._send_json(LOGS.query(int(after) if after else None, min(int(limit), LOG_STORE_SIZE)))
+
+    # ---- Парк устройств ----
+    @ROUTER.route("GET", "/api/devices")
+    def _api_devices(self, req:Request):
+        return self._send_json({"devices": device_list()})
+
+    @ROUTER.route("GET", "/api/devices/summary")
+    def _api_devices_summary(self, req:Request):
+        return self._send(200, "application/json; charset=utf-8", devices_summary())
+
+    @ROUTER.route("GET", "/api/devices/<id>/state")
+    def _api_device_state(self, req:Request):
+        store = device_store(req.params["id"])
+        if store is None:
+            return self._send(404, "text/plain; charset=utf-8", b"Unknown device")
+        return self._send_state(req, store)
+
+    @ROUTER.route("GET", "/metrics")
+    def _metrics(self, req:Request):
+        return self._send(200, "text/plain; version=0.0.4; charset=utf-8", METRICS.render())
+
+    # ---- Профилирование (ADMIN_TOKEN — заголовок X-Admin-Token) ----
+    # В многопроцессном режиме сэмплер и флаг спанов — свои у процесса, принявшего запрос.
+    def _admin_denied(self) -> bool:
+        if ADMIN_TOKEN and not hmac.compare_digest(self.headers.get("X-Admin-Token", ""), ADMIN_TOKEN):
+            self._send(403, "text/plain; charset=utf-8", b"Admin token required")
+            return True
+        return False
+
+    def _profile_args(self, req:Request):
+        hz, seconds = req.arg("hz", str(PROFILE_HZ)), req.arg("seconds", str(PROFILE_MAX_SECONDS))
+        try:
+            hz, seconds = int(hz), float(seconds)
+        except ValueError:
+            return None
+        if not 1 <= hz <= 1000 or not 0 < seconds <= PROFILE_MAX_SECONDS:
+            return None
+        return hz, seconds
+
+    def _send_profile(self, body:bytes):
+        headers = {"X-Profile-Samples": str(PROFILER.samples), "X-Profile-Hz": str(PROFILER.hz),
+                   "X-Profile-Overflow": str(PROFILER.overflow)}
+        return self._send(200, "text/plain; charset=utf-8", body, headers)
+
+    @ROUTER.route("POST", "/api/admin/profile/start")
+    def _profile_start(self, req:Request):
+        if self._admin_denied():
+            return
+        args = self._profile_args(req)
+        if args is None:
+            return self._send(400, "text/plain; charset=utf-8", b"Bad hz/seconds")
+        if not PROFILER.start(*args):
+            return self._send(409, "text/plain; charset=utf-8", b"Profiler already running")
+        return self._send_json({"running": True, "hz": args[0], "seconds": args[1]})
+
+    @ROUTER.route("POST", "/api/admin/profile/stop")
+    def _profile_stop(self, req:Request):
+        if self._admin_denied():
+            return
+        body = PROFILER.stop()
+        if body is None:
+            return self._send(409, "text/plain; charset=utf-8", b"Profiler not running")
+        return self._send_profile(body)
+
+    @ROUTER.route("GET", "/api/admin/profile")
+    def _profile_run(self, req:Request):
+        """Снять профиль за ?seconds= (держит поток пула на это время)."""
+        if self._admin_denied():
+            return
+        args = self._profile_args(req) if req.arg("seconds") else None
+        if args is None:
+            return self._send(400, "text/plain; charset=utf-8", b"Bad hz/seconds")
+        if not PROFILER.start(*args):
+            return self._send(409, "text/plain; charset=utf-8", b"Profiler already running")
+        time.sleep(args[1])
+        return self._send_profile(PROFILER.stop() or b"")
+
+    @ROUTER.route("GET", "/api/admin/spans")
+    def _spans_get(self, req:Request):
+        if self._admin_denied():
+            return
+        return self._send_json({"enabled": SPANS})
+
+    @ROUTER.route("POST", "/api/admin/spans")
+    def _spans_set(self, req:Request):
+        global SPANS
+        if self._admin_denied():
+            return
+        on = req.arg("on")
+        if on not in ("0", "1"):
+            return self._send(400, "text/plain; charset=utf-8", b"Bad on (0|1)")
+        SPANS = on == "1"
+        return self._send_json({"enabled": SPANS})
+
+    @ROUTER.route("GET", "/update.html")
+    def _update_page(self, req:Request):
+        log(">>> Отправить команду на включение WIFI <<<")
+        return self._send_static(req.path)
+
+    @ROUTER.route("GET", "/update_esp")
+    def _update_esp(self, req:Request):
+        # Отдаём адрес страницы обновления ESP (через _send — нужен Content-Length для keep-alive)
+        return self._send(200, "text/plain", b"http://192.168.0.194/update")
+
+    # ---- История ----
+    @ROUTER.route("GET", "/api/history")
+    def _api_history(self, req:Request):
+        now = time.time()
+        try:
+            t1 = float(req.arg("to", now))
+            t0 = float(req.arg("from", t1 - 3600))
+            points = max(1, min(2000, int(req.arg("points", "300"))))
+        except ValueError:
+            return self._send(400, "text/plain; charset=utf-8", b"Bad from/to/points")
+        channel = req.arg("channel")
+        if not channel:
+            body = {"channels": history_channels()}
+        else:
+            body = history_query(channel, t0, t1, points)
+            if body is None:
+                return self._send(404, "text/plain; charset=utf-8", b"Unknown channel")
+        return self._send_json(body)
+
+    @ROUTER.route("GET", "/api/telemetry")
+    def _api_telemetry(self, req:Request):
+        if TELEMETRY is None:
+            return self._send(404, "text/plain; charset=utf-8", b"Telemetry store disabled")
+        now = time.time()
+        try:
+            t1 = float(req.arg("to", now))
+            t0 = float(req.arg("from", t1 - 86400))
+            points = max(1, min(5000, int(req.arg("points", "500"))))
+        except ValueError:
+            return self._send(400, "text/plain; charset=utf-8", b"Bad from/to/points")
+        body = TELEMETRY.query(req.arg("channel"), t0, t1, points)
+        if body is None:
+            return self._send(404, "text/plain; charset=utf-8", b"Unknown channel")
+        return self._send_json(body)
+
+    # ---- Команды модему: 202 + id, статус — GET /api/commands/<id>
+    def _switch_command(self, req:Request, name:str):
+        state_val = req.arg("state").lower()
+        if state_val not in ("on", "off"):
+            return self._send(400, "text/plain; charset=utf-8", b"state must be on|off")
+        return self._send_command(name, state_val == "on")
+
+    @ROUTER.route("GET", "/api/modem/power")
+    def _api_power(self, req:Request):
+        return self._switch_command(req, "power")
+
+    @ROUTER.route("GET", "/api/modem/off-temp")
+    def _api_off_temp(self, req:Request):
+        return self._switch_command(req, "off_temp")
+
+    @ROUTER.route("GET", "/api/wifi")
+    def _api_wifi(self, req:Request):
+        return self._switch_command(req, "wifi")
+
+    @ROUTER.route("GET", "/api/wifi/password")
+    def _api_wifi_password(self, req:Request):
+        return self._send_command("wifi_password", req.arg("password"))
+
+    @ROUTER.route("GET", "/api/wifi/ssid")
+    def _api_wifi_ssid(self, req:Request):
+        return self._send_command("ssid", req.arg("ssid"))
+
+    @ROUTER.route("GET", "/api/antenna/retarget")
+    def _api_retarget(self, req:Request):
+        log("Повторное наведение инициировано")
+        return self._send_command("retarget")
+
+    @ROUTER.route("POST", "/api/batch")
+    def _api_batch(self, req:Request):
+        try:
+            ops = json.loads(req.body or b"null")
+        except ValueError:
+            return self._send(400, "text/plain; charset=utf-8", b"Bad JSON")
+        patch, errors = parse_batch(ops)
+        if errors:
+            return self._send_json({"errors": errors}, 400)
+        return self._send_command("settings", patch)
+
+    @ROUTER.route("GET", "/api/commands")
+    def _api_commands(self, req:Request):
+        return self._send_json({"commands": COMMANDS.recent()})
+
+    @ROUTER.route("GET", "/api/commands/<int:id>")
+    def _api_command(self, req:Request):
+        cmd = COMMANDS.status(req.params["id"])
+        if cmd is None:
+            return self._send(404, "text/plain; charset=utf-8", b"Unknown command")
+        return self._send_json(cmd)
+
+    # ---- Корень и статика ----
+    @ROUTER.route("GET", "/")
+    def _index(self, req:Request):
+        # Корень: строго index.html
+        index_path = os.path.join(DOC_ROOT, INDEX_FILE)
+        if os.path.isfile(index_path):
+            return self._send_file(index_path, "text/html; charset=utf-8")
+        return self._send(404, "text/plain; charset=utf-8", b"index.html not found")
+
+    def _send_static(self, path:str):
+        local = safe_local_path(path)
+        if local and os.path.isfile(local):
+            ctype, _ = mimetypes.guess_type(local)
+            if not ctype:
+                ctype = "application/octet-stream"
+            return self._send_file(local, ctype)
         return self._send(404, "text/plain; charset=utf-8", b"Not found")
 
-def bind_http_with_fallback(host:str, port:int):
-    """Пробуем привязать HTTP. Если PermissionError — уходим на 127.0.0.1:0 (автопорт)."""
+# Гистограмма задержек по маршрутам таблицы (+ отдельные метки для дельт, статики и промахов)
+M_HTTP_REQUESTS = METRICS.histogram_vec("iot_http_request_duration_seconds",
+                                        "Время обработки запроса (без SSE-потоков)", LATENCY_BUCKETS,
+                                        "route", ROUTER.labels() + ("/api/state?since", "static", "other"))
+for _route in ROUTER.routes:
+    _route.metric = M_HTTP_REQUESTS[_route.pattern]
+
+class KeepAliveHandler(Handler):
+    """Handler для пула: HTTP/1.1 keep-alive. Поток пула обрабатывает один запрос и отдаёт соединение
+    обратно серверу; простаивающий сокет ждёт следующего запроса в селекторе, а не в потоке."""
+    protocol_version = "HTTP/1.1"
+    timeout = HTTP_IDLE_TIMEOUT   # страховка от медленного клиента посреди запроса (простой ловит селектор)
+    allow_streams = True
+    detached = False  # соединение передано SSE — сервер его не паркует и не закрывает
+    # заголовки и тело уходят отдельными write: без TCP_NODELAY на keep-alive ждём delayed ACK (~40 мс)
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+
+    def finish(self):
+        # соединение остаётся открытым — rfile с его буфером нужен следующему запросу
+        if self.close_connection:
+            super().finish()
+
+    def serve_next(self):
+        """Следующий запрос на уже открытом соединении (сокет стал читаемым)."""
+        self.handle()
+        self.finish()
+
+    def has_buffered(self) -> bool:
+        """Следующий запрос уже прочитан в буфер rfile (конвейер) — селектор его не увидит."""
+        sock = self.connection
+        try:
+            sock.setblocking(False)
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            try:
+                sock.settimeout(self.timeout)
+            except OSError:
+                pass
+
+    def log_error(self, format, *args):
+        # закрытие простаивающего keep-alive — штатная ситуация, не шумим
+        if format.startswith("Request timed out"):
+            return
+        super().log_error(format, *args)
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer с ограниченным пулом потоков и лимитом одновременных соединений.
+    Потоки заняты только запросами: новые и keep-alive-сокеты между запросами «припаркованы» в селекторе
+    отдельного потока и попадают в очередь пула, когда от клиента пришли данные.
+    Простой дольше HTTP_IDLE_TIMEOUT — закрытие; при исчерпании HTTP_MAX_CONN новое соединение
+    вытесняет самое давнее простаивающее, 503 — только если простаивающих нет."""
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self, addr, handler, workers:int, max_conn:int, bind_and_activate:bool=True):
+        self._conns = queue.Queue()          # соединения с пришедшим запросом: (сокет, адрес) нового или handler
+        self._slots = threading.BoundedSemaphore(max(1, max_conn))
+        self._workers = max(1, workers)
+        self._to_park = queue.SimpleQueue()  # (сокет, адрес) или handler → селектор; None — вытеснить давний
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._idle = 0                       # сейчас в селекторе (для решения «вытеснять или 503»)
+        super().__init__(addr, handler, bind_and_activate)
+
+    def serve_forever(self, poll_interval=0.5):
+        # потоки пула стартуют здесь, а не в __init__: сервер можно создать до fork
+        for i in range(self._workers):
+            threading.Thread(target=self._worker, name=f"http-{i}", daemon=True).start()
+        threading.Thread(target=self._parker, name="http-idle", daemon=True).start()
+        super().serve_forever(poll_interval)
+
+    def queued(self) -> int:
+        """Соединения с запросом, ждущие свободного потока."""
+        return self._conns.qsize()
+
+    def idle(self) -> int:
+        """Keep-alive-соединения, простаивающие в селекторе."""
+        return self._idle
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(blocking=False):
+            if self._idle > 0:
+                self._wake(None)  # освободить место за счёт самого давнего простаивающего
+            if self._idle <= 0 or not self._slots.acquire(timeout=0.5):
+                METRICS.inc(M_HTTP_REJECTED)
+                # лимит соединений исчерпан — сразу отвечаем 503, не занимая поток
+                try:
+                    request.sendall(b"HTTP/1.1 503 Service Unavailable\r\n"
+                                    b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+                except OSError:
+                    pass
+                self.shutdown_request(request)
+                return
+        self._wake((request, client_address))
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def _worker(self):
+        while True:
+            item = self._conns.get()
+            handler = None
+            try:
+                if isinstance(item, tuple):
+                    request, client_address = item
+                    handler = self.finish_request(request, client_address)
+                else:
+                    handler, request, client_address = item, item.connection, item.client_address
+                    handler.serve_next()
+            except Exception:
+                handler = None
+                self.handle_error(request, client_address)
+            if handler is not None and handler.detached:
+                continue  # сокет передан SSE, закроет он
+            if handler is not None and not handler.close_connection:
+                if handler.has_buffered():
+                    self._conns.put(handler)
+                else:
+                    self._wake(handler)
+                continue
+            self.release(request)
+
+    def release(self, request):
+        """Закрыть соединение и вернуть его место в HTTP_MAX_CONN."""
+        self.shutdown_request(request)
+        self._slots.release()
+
+    def _wake(self, item):
+        self._to_park.put(item)
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            pass
+
+    @staticmethod
+    def _sock(item):
+        return item[0] if isinstance(item, tuple) else item.connection
+
+    def _parker(self):
+        """Поток селектора: простаивающие соединения, их таймауты и вытеснение."""
+        sel = selectors.DefaultSelector()
+        sel.register(self._wake_r, selectors.EVENT_READ)
+        parked = {}   # соединение -> срок простоя; порядок вставки = порядок сроков, первым — самый давний
+        while True:
+            for key, _ in sel.select(1.0):
+                if key.fileobj is self._wake_r:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                sel.unregister(key.fileobj)
+                del parked[key.data]
+                self._conns.put(key.data)
+            evict = 0
+            while True:
+                try:
+                    item = self._to_park.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    evict += 1
+                    continue
+                try:
+                    sel.register(self._sock(item), selectors.EVENT_READ, item)
+                except (OSError, ValueError):
+                    self.release(self._sock(item))
+                    continue
+                parked[item] = time.monotonic() + HTTP_IDLE_TIMEOUT
+            now = time.monotonic()
+            for item, deadline in list(parked.items()):
+                if deadline > now and evict <= 0:
+                    break
+                if deadline > now:
+                    evict -= 1
+                del parked[item]
+                sel.unregister(self._sock(item))
+                if not isinstance(item, tuple):
+                    item.close_connection = True
+                    try:
+                        item.finish()
+                    except OSError:
+                        pass
+                self.release(self._sock(item))
+            self._idle = len(parked)
+
+def make_http_server(addr, reuse_port:bool=False):
+    """Создаёт HTTP-сервер в режиме HTTP_ENGINE. reuse_port — SO_REUSEPORT: несколько процессов
+    слушают один порт, ядро раскладывает соединения между ними."""
+    if HTTP_ENGINE == "single":
+        httpd = HTTPServer(addr, Handler, bind_and_activate=False)
+    else:
+        httpd = PooledHTTPServer(addr, KeepAliveHandler, HTTP_WORKERS, HTTP_MAX_CONN, bind_and_activate=False)
+    try:
+        if reuse_port:
+            httpd.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        httpd.server_bind()
+        httpd.server_activate()
+    except BaseException:
+        httpd.server_close()
+        raise
+    return httpd
+
+def bind_http_with_fallback(host:str, port:int, reuse_port:bool=False):
+    """Пробуем привязать HTTP. Если PermissionError — уходим на 127.0.0.1:0 (автопорт).
+    С reuse_port остальные HTTP-процессы потом садятся на фактический адрес этого сервера."""
     try:
-        httpd = HTTPServer((host, port), Handler)
+        httpd = make_http_server((host, port), reuse_port)
         return httpd
     except PermissionError as e:
-        log(f"bind PermissionError on {host}:{port} -> fallback to 127.0.0.1:0")
-        httpd = HTTPServer(("127.0.0.1", 0), Handler)
+        log(f"bind PermissionError on {host}:{port} -> fallback to 127.0.0.1:0", level="warn")
+        httpd = make_http_server(("127.0.0.1", 0), reuse_port)
         return httpd
     except OSError as e:
         # например, недопустимый адрес или занят порт — тоже попробуем фолбэк
-        log(f"bind OSError on {host}:{port} -> fallback to 127.0.0.1:0 ({e})")
-        httpd = HTTPServer(("127.0.0.1", 0), Handler)
+        log(f"bind OSError on {host}:{port} -> fallback to 127.0.0.1:0", level="warn", err=e)
+        httpd = make_http_server(("127.0.0.1", 0), reuse_port)
         return httpd
 
+# ================== МНОГОПРОЦЕССНЫЙ РЕЖИМ ==================
+# Основной процесс: UART, команды, история, парк. Он форкает HTTP_PROCESSES HTTP-процессов до запуска
+# своих потоков. Первый наследует уже привязанный сервер, остальные садятся на тот же адрес с SO_REUSEPORT.
+# STATE основного устройства идёт в HTTP-процессы через общую память (SharedState). Остальное —
+# команды, история, телеметрия, парк — запросами к основному процессу по socketpair (WorkerLink).
+
+class SharedState:
+    """JSON состояния в общей памяти (анонимный mmap до fork). Один писатель, читатели без блокировок:
+    seqlock — нечётный seq значит «идёт запись», прочитанное верно, если seq до и после совпал."""
+    HEADER = struct.Struct("<QQI")   # seq, версия, длина JSON
+    SEQ = struct.Struct("<Q")
+
+    def __init__(self, size:int):
+        self.mem = mmap.mmap(-1, self.HEADER.size + size)
+        self.size = size
+        self._seq = 0
+
+    def publish(self, version:int, body:bytes) -> bool:
+        if len(body) > self.size:
+            return False
+        mem, h = self.mem, self.HEADER.size
+        self._seq += 1
+        self.SEQ.pack_into(mem, 0, self._seq)           # нечётный: читатели ждут
+        mem[h:h + len(body)] = body
+        self._seq += 1
+        self.HEADER.pack_into(mem, 0, self._seq, version, len(body))
+        return True
+
+    def read(self, known:int):
+        """(version, body) или (version, None), если версия равна known."""
+        mem, h = self.mem, self.HEADER.size
+        while True:
+            seq, version, n = self.HEADER.unpack_from(mem, 0)
+            if seq & 1:
+                time.sleep(0)
+                continue
+            if version == known:
+                return version, None
+            body = mem[h:h + n]
+            if self.SEQ.unpack_from(mem, 0)[0] == seq:
+                return version, body
+
+def publish_shared_state(shared:SharedState):
+    """Основной процесс: каждая новая версия STATE → общая память."""
+    version = None
+    while True:
+        v, body, _ = state_snapshot()
+        if v != version:
+            if not shared.publish(v, body):
+                log(f"STATE ({len(body)} байт) не помещается в STATE_SHM_SIZE={STATE_SHM_SIZE}", level="error")
+            version = v
+        wait_state_change(version, 1.0)
+
+def follow_shared_state(shared:SharedState):
+    """HTTP-процесс: новая версия в общей памяти → локальный снимок (ETag, ?since=, SSE работают как обычно)."""
+    version = None
+    while True:
+        try:
+            v, body = shared.read(version)
+            if body is not None:
+                STATE_STORE.replace(v, json.loads(body), body)
+                version = v
+        except Exception as e:
+            log("follow_shared_state err", level="error", err=e)
+        time.sleep(STATE_SHM_POLL)
+
+def metrics_publisher():
+    """Итоги метрик процесса → общая память: /metrics любого HTTP-процесса показывает весь сервер."""
+    while True:
+        METRICS.publish()
+        time.sleep(1.0)
+
+def _rpc_default(v):
+    if isinstance(v, (bytes, bytearray)):
+        return v.decode("utf-8")
+    raise TypeError(type(v).__name__)
+
+class WorkerLink:
+    """Вызовы из HTTP-процесса в основной: строка JSON [имя, аргументы] → {"result": ...} или {"error": ...}."""
+
+    def __init__(self, sock):
+        self._f = sock.makefile("rwb")
+        self._lock = threading.Lock()
+
+    def call(self, name:str, *args):
+        line = json.dumps([name, args], ensure_ascii=False).encode("utf-8") + b"\n"
+        with self._lock:
+            self._f.write(line)
+            self._f.flush()
+            reply = self._f.readline()
+        if not reply:
+            raise ConnectionError("основной процесс не отвечает")
+        reply = json.loads(reply)
+        if "error" in reply:
+            raise RuntimeError(f"{name}: {reply['error']}")
+        return reply["result"]
+
+def rpc_methods() -> dict:
+    """Что HTTP-процессы спрашивают у основного (вызывается в основном процессе)."""
+    def snapshot(dev_id):
+        version, body, etag = DEVICES[dev_id].store.snapshot()
+        return version, body, etag
+    def log_batch(recs):
+        # записи HTTP-процесса (уже с его меткой) — в общий файл и журнал
+        for rec in recs:
+            LOGGER.put(tuple(rec))
+    return {
+        "submit": COMMANDS.submit,
+        "status": COMMANDS.status,
+        "recent": COMMANDS.recent,
+        "depth": COMMANDS.depth,
+        "history_channels": history_channels,
+        "history_query": history_query,
+        "telemetry_query": lambda *a: TELEMETRY.query(*a),
+        "device_list": device_list,
+        "device_known": lambda dev_id: dev_id in DEVICES,
+        "device_snapshot": snapshot,
+        "device_delta": lambda dev_id, since: DEVICES[dev_id].store.delta(since),
+        "devices_summary": devices_summary,
+        "log_batch": log_batch,
+        "log_query": LOGS.query,
+    }
+
+def serve_worker_link(sock, methods:dict):
+    """Основной процесс: отвечает на вызовы одного HTTP-процесса (поток на процесс)."""
+    f = sock.makefile("rwb")
+    for line in f:
+        try:
+            name, args = json.loads(line)
+            reply = {"result": methods[name](*args)}
+        except Exception as e:
+            reply = {"error": f"{type(e).__name__}: {e}"}
+        f.write(json.dumps(reply, ensure_ascii=False, default=_rpc_default).encode("utf-8") + b"\n")
+        f.flush()
+
+class RemoteCommands:
+    """COMMANDS в HTTP-процессе: очередь живёт в основном процессе."""
+    def __init__(self, link:WorkerLink):
+        self._call = link.call
+    def submit(self, name:str, value=None) -> dict:
+        return self._call("submit", name, value)
+    def status(self, cmd_id:int):
+        return self._call("status", cmd_id)
+    def recent(self) -> list:
+        return self._call("recent")
+    def depth(self) -> int:
+        return self._call("depth")
+
+class RemoteTelemetry:
+    """TELEMETRY в HTTP-процессе (журнал на флеше пишет основной процесс)."""
+    def __init__(self, link:WorkerLink):
+        self._call = link.call
+    def query(self, name:str, t0:float, t1:float, points:int):
+        return self._call("telemetry_query", name, t0, t1, points)
+
+class RemoteLogs:
+    """LOGS в HTTP-процессе: журнал один — в основном процессе."""
+    def __init__(self, link:WorkerLink):
+        self._call = link.call
+    def query(self, after, limit:int) -> dict:
+        return self._call("log_query", after, limit)
+
+class RemoteStore:
+    """Состояние устройства парка для _send_state в HTTP-процессе."""
+    def __init__(self, link:WorkerLink, dev_id:str):
+        self._call = link.call
+        self.dev_id = dev_id
+    def snapshot(self):
+        version, body, etag = self._call("device_snapshot", self.dev_id)
+        return version, body.encode("utf-8"), etag
+    def delta(self, since:int):
+        version, patch = self._call("device_delta", self.dev_id, since)
+        return version, patch
+
+def become_worker(index:int, link:WorkerLink):
+    """HTTP-процесс после fork: данные основного процесса — через link."""
+    global LOG_TAG, LOGS, COMMANDS, TELEMETRY, history_channels, history_query, device_list, device_store, devices_summary
+    LOG_TAG = f"[srv w{index}]"
+    LOGS = RemoteLogs(link)
+    LOGGER.reset()
+    LOGGER.forward = lambda recs: link.call("log_batch", recs)
+    COMMANDS = RemoteCommands(link)
+    TELEMETRY = RemoteTelemetry(link) if TELEMETRY_DIR else None
+    history_channels = lambda: link.call("history_channels")
+    history_query = lambda *a: link.call("history_query", *a)
+    device_list = lambda: link.call("device_list")
+    device_store = lambda dev_id: RemoteStore(link, dev_id) if link.call("device_known", dev_id) else None
+    devices_summary = lambda: link.call("devices_summary").encode("utf-8")
+
+def watch_parent(parent:int):
+    """HTTP-процесс не переживает основной (порт иначе остался бы занят сиротами)."""
+    while os.getppid() == parent:
+        time.sleep(1.0)
+    os._exit(0)
+
+def worker_main(index:int, httpd, sock, shared:SharedState, parent:int):
+    """Тело HTTP-процесса; не возвращается."""
+    try:
+        become_worker(index, WorkerLink(sock))
+        METRICS.attach(index)
+        LOGGER.start()
+        threading.Thread(target=watch_parent, args=(parent,), daemon=True).start()
+        threading.Thread(target=follow_shared_state, args=(shared,), daemon=True).start()
+        threading.Thread(target=metrics_publisher, daemon=True).start()
+        serve_http(httpd)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        log("worker err:", e, level="error")
+    finally:
+        LOGGER.close()
+        os._exit(0)
+
+def spawn_http_workers(httpd) -> list:
+    """Форкает HTTP_PROCESSES HTTP-процессов (до запуска потоков основного). Возвращает их pid."""
+    shared = SharedState(STATE_SHM_SIZE)
+    _, body, _ = state_snapshot()
+    shared.publish(state_current().version, body)
+    METRICS.share(HTTP_PROCESSES + 1)
+    addr = httpd.server_address
+    parent = os.getpid()
+    links, pids = [], []
+    for i in range(1, HTTP_PROCESSES + 1):
+        parent_sock, child_sock = socket.socketpair()
+        # первый процесс берёт уже привязанный сервер (с фолбэком), остальные — тот же адрес
+        server = httpd if i == 1 else make_http_server(addr, reuse_port=True)
+        pid = os.fork()
+        if pid == 0:
+            parent_sock.close()
+            for s, _ in links:
+                s.close()
+            if server is not httpd:
+                httpd.server_close()
+            worker_main(i, server, child_sock, shared, parent)
+        child_sock.close()
+        if server is not httpd:
+            server.server_close()
+        links.append((parent_sock, pid))
+        pids.append(pid)
+    httpd.server_close()  # основной процесс соединения не принимает
+
+    methods = rpc_methods()
+    for sock, pid in links:
+        threading.Thread(target=serve_worker_link, args=(sock, methods), name=f"link-{pid}", daemon=True).start()
+    threading.Thread(target=publish_shared_state, args=(shared,), daemon=True).start()
+    threading.Thread(target=metrics_publisher, daemon=True).start()
+    return pids
+
+def serve_http(httpd):
+    """Цикл HTTP (основной процесс или HTTP-процесс многопроцессного режима)."""
+    # Мгновенные значения для /metrics: насыщение видно по очередям
+    METRICS.gauge("iot_state_version", "Версия STATE", lambda: state_current().version)
+    METRICS.gauge("iot_commands_queued", "Команд UART в очереди", COMMANDS.depth)
+    METRICS.gauge("iot_log_queued", "Записей лога, ждущих фонового писателя", LOGGER.depth)
+    if isinstance(httpd, PooledHTTPServer):
+        METRICS.gauge("iot_http_queued_connections", "Соединения, ждущие потока пула", httpd.queued)
+        METRICS.gauge("iot_http_idle_connections", "Keep-alive-соединения, простаивающие в селекторе", httpd.idle)
+    httpd.serve_forever()
+
+def wait_http_workers(pids:list):
+    """Основной процесс многопроцессного режима: ждёт HTTP-процессы (UART и команды живут в потоках)."""
+    alive = set(pids)
+    while alive:
+        pid, status = os.wait()
+        if pid in alive:
+            alive.discard(pid)
+            log(f"HTTP-процесс {pid} завершился (код {os.waitstatus_to_exitcode(status)}), осталось {len(alive)}")
+
 def main():
+    global TELEMETRY
+    # HTTP + фолбэк — первым: в многопроцессном режиме fork должен случиться до запуска потоков
+    multi = HTTP_PROCESSES > 1 and hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")
+    if HTTP_PROCESSES > 1 and not multi:
+        log("HTTP_PROCESSES: нужны fork и SO_REUSEPORT — работаем одним процессом")
+    httpd = bind_http_with_fallback(HTTP_HOST, HTTP_PORT, reuse_port=multi)
+    bind_host, bind_port = httpd.server_address  # фактический адрес
+    log(f"HTTP listening on {bind_host}:{bind_port} (docroot: {DOC_ROOT}, engine: {HTTP_ENGINE}, "
+        f"processes: {HTTP_PROCESSES if multi else 1})")
+    workers = spawn_http_workers(httpd) if multi else []
+    LOGGER.start()  # после fork: записи выше выведет основной процесс
+    if workers:
+        # kill / остановка службы → finally ниже гасит HTTP-процессы и сбрасывает телеметрию
+        signal.signal(signal.SIGTERM, lambda *a: sys.exit(0))
+
+    # Журнал телеметрии на флеше (по желанию)
+    if TELEMETRY_DIR:
+        TELEMETRY = TelemetryStore(TELEMETRY_DIR)
+        TELEMETRY.preload_history(time.time() - TELEMETRY_PRELOAD)
+        threading.Thread(target=TELEMETRY.run, daemon=True).start()
+        log(f"telemetry store: {TELEMETRY_DIR}")
+
+    # Остальные устройства парка (FLEET / FLEET_SIM) — один общий поток
+    start_fleet()
+
+    # Поток-писатель команд модему
+    threading.Thread(target=COMMANDS.run, daemon=True).start()
+
     # UART поток (если pyserial есть)
     if serial is not None:
         threading.Thread(target=uart_reader, daemon=True).start()
     else:
-        log("pyserial отсутствует — установите: pip install pyserial")
+        log("pyserial отсутствует — установите: pip install pyserial", level="warn")
 
     # Эмуляция температуры (по умолчанию включена)
     if FAKE_TEMP:
         threading.Thread(target=fake_temp_generator, daemon=True).start()
         log("FAKE_TEMP активен — температура будет эмулироваться")
 
-    # HTTP + фолбэк
-    httpd = bind_http_with_fallback(HTTP_HOST, HTTP_PORT)
-    bind_host, bind_port = httpd.server_address  # фактический адрес
-    log(f"HTTP listening on {bind_host}:{bind_port} (docroot: {DOC_ROOT})")
-
     try:
-        httpd.serve_forever()
+        if workers:
+            wait_http_workers(workers)
+        else:
+            serve_http(httpd)
     except KeyboardInterrupt:
         pass
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        if TELEMETRY is not None:
+            TELEMETRY.flush()
+        LOGGER.close()
 
 if __name__ == "__main__":
     main()
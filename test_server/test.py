@@ -1,5 +1,11 @@
 # server.py
-from flask import Flask, request, jsonify, redirect, url_for, render_template_string, abort
+import os
+import json
+import threading
+from contextlib import contextmanager
+import time
+from collections import deque
+from flask import Flask, request, jsonify, redirect, url_for, render_template, abort
 
 app = Flask(__name__)
 
@@ -42,13 +48,14 @@ state = {
     # пароль Wi-Fi храним открыто
     "wifi_password": "12345678",          # Пароль Wi-Fi
 
-    # логи (максимум 10 последних строк)
-    "logs": [
-        "log1",                           # Пример лога
-        "log2"                            # Пример лога
-    ]
+    # номер последней записи лога; сами записи — в log_entries, отдаются через /api/logs
+    "log_seq": 0
 }
 
+LOG_STORE_SIZE = 500      # сколько записей лога держим в памяти
+LOG_PAGE_SIZE = 10        # сколько последних строк показываем на странице
+log_entries = deque(maxlen=LOG_STORE_SIZE)
+
 
 # ===== CORS/Cache =====
 # Разрешаем фронт с Go Live и file:// (Origin: null) — для DEV.
@@ -95,93 +102,196 @@ def _to_float(v, default=None):
     except Exception:
         return default
 
-def add_log(line: str):
-    state["logs"].append(line)
-    if len(state["logs"]) > 10:
-        state["logs"] = state["logs"][-10:]
+# ===== ядро состояния: любая запись в state — только внутри state_write() =====
+# Flask (threaded=True) обслуживает запросы в разных потоках, плюс поток сценария:
+# без замка вложенные update давали «рваное» состояние. Читатели (JSON, страница) — тоже под замком.
+state_lock = threading.RLock()  # реентерабельный: add_log вызывается изнутри других записей
+state_version = 0  # растёт при каждом изменении state: ключ кэша страницы и /api/state
+
+@contextmanager
+def state_write():
+    """Изменение state под замком; на выходе — новая версия (кэш страницы и JSON сбрасывается)."""
+    global state_version
+    with state_lock:
+        try:
+            yield state
+        finally:
+            state_version += 1
+
+# ===== пакет настроек (/api/batch) — тот же формат, что у iot_simple_server.py =====
+
+def _batch_switch(v):
+    if isinstance(v, bool):
+        return v
+    if isinstance(v, str) and v.lower() in ("on", "off"):
+        return v.lower() == "on"
+    raise ValueError("value must be on|off")
+
+def _batch_text(max_len):
+    def check(v):
+        if not isinstance(v, str) or len(v) > max_len:
+            raise ValueError(f"value must be a string up to {max_len} chars")
+        return v
+    return check
+
+BATCH_OPS = {
+    "power":         ("power", _batch_switch),
+    "off_temp":      ("modem_off_temp", _batch_switch),
+    "wifi":          ("wifi_on", _batch_switch),
+    "ssid":          ("ssid", _batch_text(32)),
+    "wifi_password": ("wifi_password", _batch_text(64)),
+}
+
+def apply_batch(ops):
+    """Проверяет все операции, затем применяет их разом под state_lock. Возвращает (changes, errors)."""
+    if isinstance(ops, dict):
+        ops = ops.get("ops")
+    if not isinstance(ops, list) or not ops:
+        return None, [{"index": None, "error": "expected {\"ops\": [...]} with at least one op"}]
+    changes, errors = {}, []
+    for i, op in enumerate(ops):
+        name = op.get("op") if isinstance(op, dict) else None
+        try:
+            if name == "coords":
+                lat, lng = _to_float(op.get("lat")), _to_float(op.get("lng"))
+                if lat is None or lng is None or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+                    raise ValueError("lat/lng out of range")
+                changes["coords"] = {"lat": lat, "lng": lng}
+            elif name in BATCH_OPS:
+                key, check = BATCH_OPS[name]
+                changes[key] = check(op.get("value"))
+            else:
+                raise ValueError(f"unknown op {name!r}")
+        except (ValueError, TypeError) as e:
+            errors.append({"index": i, "op": name, "error": str(e)})
+    if errors:
+        return None, errors
+    with state_write():
+        for k, v in changes.items():
+            if isinstance(v, dict):
+                state[k].update(v)
+            else:
+                state[k] = v
+    return changes, []
+
+def add_log(line: str, source: str = "test"):
+    """Добавляет запись в лог под state_lock и возвращает её."""
+    with state_write():
+        state["log_seq"] += 1
+        entry = {
+            "seq": state["log_seq"],
+            "t": time.time(),
+            "time": time.strftime("%d.%m.%Y, %H:%M"),
+            "source": source,
+            "text": line,
+            "repeat": 1,
+        }
+        log_entries.append(entry)
+    return entry
+
+def query_logs(after=None, limit=LOG_PAGE_SIZE):
+    """Записи с seq > after (или последние limit) — тот же ответ, что /api/logs у iot_simple_server.py."""
+    with state_lock:
+        entries = list(log_entries)
+        seq = state["log_seq"]
+    first = entries[0]["seq"] if entries else seq + 1
+    if after is None:
+        page = entries[-limit:] if limit else []
+        more = False
+        truncated = False
+    else:
+        newer = [e for e in entries if e["seq"] > after]
+        page = newer[:limit]
+        more = len(newer) > limit
+        truncated = after + 1 < first
+    return {"seq": seq, "first": first, "truncated": truncated, "more": more, "entries": page}
+
+add_log("log1")
+add_log("log2")
 
 def apply_form_to_state(form):
-    # булевы
-    for k in ["power", "wifi_on", "modem_off_temp"]:
-        state[k] = (k in form)
-
-    # строки/числа
-    if "mac" in form:
-        state["mac"] = form.get("mac", "").strip()
-
-    if "temp_c" in form:
-        v = _to_int(form.get("temp_c"), state["temp_c"])
-        if v is not None:
-            state["temp_c"] = v
-
-    # попытка
-    if "attempt" in form:
-        v = _to_int(form.get("attempt"), state["attempt"])
-        if v is not None:
-            state["attempt"] = v
-
-    # статусы
-    if form.get("coords_status") in STATUS3:
-        state["coords_status"] = form.get("coords_status")
-    if form.get("gps_status") in STATUS3:
-        state["gps_status"] = form.get("gps_status")
-    if form.get("inet_status") in STATUS3:
-        state["inet_status"] = form.get("inet_status")
-    if form.get("system") in SYSTEM_STATES:
-        state["system"] = form.get("system")
-
-    # coords
-    if "coords.lat" in form:
-        v = _to_float(form.get("coords.lat"), state["coords"]["lat"])
-        if v is not None:
-            state["coords"]["lat"] = v
-    if "coords.lng" in form:
-        v = _to_float(form.get("coords.lng"), state["coords"]["lng"])
-        if v is not None:
-            state["coords"]["lng"] = v
-
-    # rx/tx progress
-    if "rx.progress" in form:
-        v = _to_int(form.get("rx.progress"), state["rx"]["progress"])
-        if v is not None:
-            state["rx"]["progress"] = max(0, min(100, v))
-    if "tx.progress" in form:
-        v = _to_int(form.get("tx.progress"), state["tx"]["progress"])
-        if v is not None:
-            state["tx"]["progress"] = max(0, min(100, v))
-
-    # углы
-    for k in ("angles.tilt_current","angles.tilt_required","angles.rotate_current","angles.rotate_required"):
-        if k in form:
-            v = _to_int(form.get(k), None)
+    """Форма /set_all → state (одна запись под замком)."""
+    with state_write():
+        # булевы
+        for k in ["power", "wifi_on", "modem_off_temp"]:
+            state[k] = (k in form)
+
+        # строки/числа
+        if "mac" in form:
+            state["mac"] = form.get("mac", "").strip()
+
+        if "temp_c" in form:
+            v = _to_int(form.get("temp_c"), state["temp_c"])
             if v is not None:
-                state["angles"][k.split(".",1)[1]] = v
+                state["temp_c"] = v
 
-    # новые поля (как на скрине)
-    if "beam_number" in form:
-        v = _to_int(form.get("beam_number"), state["beam_number"])
-        if v is not None:
-            state["beam_number"] = v
+        # попытка
+        if "attempt" in form:
+            v = _to_int(form.get("attempt"), state["attempt"])
+            if v is not None:
+                state["attempt"] = v
+
+        # статусы
+        if form.get("coords_status") in STATUS3:
+            state["coords_status"] = form.get("coords_status")
+        if form.get("gps_status") in STATUS3:
+            state["gps_status"] = form.get("gps_status")
+        if form.get("inet_status") in STATUS3:
+            state["inet_status"] = form.get("inet_status")
+        if form.get("system") in SYSTEM_STATES:
+            state["system"] = form.get("system")
+
+        # coords
+        if "coords.lat" in form:
+            v = _to_float(form.get("coords.lat"), state["coords"]["lat"])
+            if v is not None:
+                state["coords"]["lat"] = v
+        if "coords.lng" in form:
+            v = _to_float(form.get("coords.lng"), state["coords"]["lng"])
+            if v is not None:
+                state["coords"]["lng"] = v
+
+        # rx/tx progress
+        if "rx.progress" in form:
+            v = _to_int(form.get("rx.progress"), state["rx"]["progress"])
+            if v is not None:
+                state["rx"]["progress"] = max(0, min(100, v))
+        if "tx.progress" in form:
+            v = _to_int(form.get("tx.progress"), state["tx"]["progress"])
+            if v is not None:
+                state["tx"]["progress"] = max(0, min(100, v))
+
+        # углы
+        for k in ("angles.tilt_current","angles.tilt_required","angles.rotate_current","angles.rotate_required"):
+            if k in form:
+                v = _to_int(form.get(k), None)
+                if v is not None:
+                    state["angles"][k.split(".",1)[1]] = v
+
+        # новые поля (как на скрине)
+        if "beam_number" in form:
+            v = _to_int(form.get("beam_number"), state["beam_number"])
+            if v is not None:
+                state["beam_number"] = v
 
-    # РЧ кластер / поляризация -> сохраняем как одну строку "X/Y"
-    if ("rf_cluster" in form) or ("polarization" in form):
-        cluster = form.get("rf_cluster", "").strip()
-        pol = form.get("polarization", "").strip()
-        if cluster or pol:
-            state["rf_cluster_polarization"] = f"{cluster}/{pol}"
+        # РЧ кластер / поляризация -> сохраняем как одну строку "X/Y"
+        if ("rf_cluster" in form) or ("polarization" in form):
+            cluster = form.get("rf_cluster", "").strip()
+            pol = form.get("polarization", "").strip()
+            if cluster or pol:
+                state["rf_cluster_polarization"] = f"{cluster}/{pol}"
 
-    # Wi-Fi пароль — сохраняем как есть
-    if "wifi_password" in form:
-        state["wifi_password"] = form.get("wifi_password", "")
+        # Wi-Fi пароль — сохраняем как есть
+        if "wifi_password" in form:
+            state["wifi_password"] = form.get("wifi_password", "")
 
-    # новый лог из формы
-    if form.get("new_log", "").strip():
-        add_log(form.get("new_log").strip())
+        # новый лог из формы
+        if form.get("new_log", "").strip():
+            add_log(form.get("new_log").strip())
 
 # ===== HTML демо-страница =====
-@app.route("/", methods=["GET"])
-def index():
-    return render_template_string("""<!doctype html>
+# Шаблон компилируется один раз при импорте; готовая страница и JSON /api/state кэшируются по state_version.
+INDEX_HTML = """<!doctype html>
 <meta charset="utf-8">
 <title>Демо-сервер состояния</title>
 <style>
@@ -341,8 +451,8 @@ def index():
     <div class="card">
       <h3>Логи</h3>
       <ul>
-        {% for line in state.logs %}
-          <li class="log-line">{{ line }}</li>
+        {% for e in logs %}
+          <li class="log-line">{{ e.time }} {{ e.text }}</li>
         {% else %}
           <li><i>Нет логов</i></li>
         {% endfor %}
@@ -360,7 +470,8 @@ def index():
 </form>
 <p class="muted" style="margin-top:16px">
   API: <code>GET /api/state</code>, <code>POST /api/state</code>,
-  <code>GET /api/logs</code>, <code>POST /api/log {"line":"..."}</code>
+  <code>GET /api/logs?after=&amp;limit=</code>, <code>POST /api/log {"line":"..."}</code>,
+  <code>GET|POST|DELETE /api/scenario {"name":"...","speed":1,"loop":false}</code>
 </p>
 <script>
 /* ===== Помощники ===== */
@@ -405,6 +516,8 @@ function bindUserEditingGuards() {
   }
 }
 
+let shownLogSeq = null;
+
 async function refreshState() {
   try {
     const resp = await fetch('/api/state', { cache: 'no-store' });
@@ -449,13 +562,17 @@ async function refreshState() {
       const newLogInput = document.getElementById('new_log');
       const userBusy = newLogInput && (newLogInput.matches(':focus') || newLogInput.dataset.userEditing === '1');
 
-      if (!userBusy) {
+      // Записи тянем отдельно и только когда сдвинулся log_seq
+      if (!userBusy && data.log_seq !== shownLogSeq) {
+        const logResp = await fetch('/api/logs', { cache: 'no-store' });
+        const page = await logResp.json();
+        shownLogSeq = page.seq;
         ul.innerHTML = '';
-        if (Array.isArray(data.logs) && data.logs.length) {
-          data.logs.forEach(line => {
+        if (Array.isArray(page.entries) && page.entries.length) {
+          page.entries.forEach(e => {
             const li = document.createElement('li');
             li.className = 'log-line';
-            li.textContent = String(line);
+            li.textContent = `${e.time} ${e.text}` + (e.repeat > 1 ? ` (x${e.repeat})` : '');
             ul.appendChild(li);
           });
         } else {
@@ -475,7 +592,37 @@ refreshState();
 setInterval(refreshState, 2000);
 </script>
 
-""", state=state, status3=STATUS3, system_states=SYSTEM_STATES)
+"""
+INDEX_TEMPLATE = app.jinja_env.from_string(INDEX_HTML)
+
+_page_cache = (None, "")    # (версия, html)
+_json_cache = (None, "")    # (версия, тело /api/state)
+
+def render_index() -> str:
+    global _page_cache
+    version, html = _page_cache
+    if version != state_version:
+        with state_lock:  # шаблон читает вложенные словари — не даём писателю менять их посреди рендера
+            version = state_version
+            html = render_template(INDEX_TEMPLATE, state=state, logs=query_logs()["entries"],
+                                   status3=STATUS3, system_states=SYSTEM_STATES)
+        _page_cache = (version, html)
+    return html
+
+def state_response():
+    """Ответ /api/state: сериализуем state только после изменения."""
+    global _json_cache
+    version, body = _json_cache
+    if version != state_version:
+        with state_lock:
+            version = state_version
+            body = json.dumps(state)
+        _json_cache = (version, body)
+    return app.response_class(body, mimetype="application/json")
+
+@app.route("/", methods=["GET"])
+def index():
+    return render_index()
 
 @app.route("/set_all", methods=["POST"])
 def set_all_form():
@@ -487,19 +634,44 @@ def set_all_form():
 def api_state():
     if request.method == "POST":
         data = request.get_json(silent=True) or {}
-        for k, v in data.items():
-            if k in ("rx", "tx", "coords", "angles") and isinstance(v, dict):
-                state[k].update(v)
-            elif k == "logs" and isinstance(v, list):
-                for line in v:
-                    add_log(str(line))
-            else:
-                state[k] = v
-    return jsonify(state)
+        if "ops" in data:
+            # тот же пакет операций, что и /api/batch
+            _, errors = apply_batch(data)
+            if errors:
+                return jsonify({"ok": False, "errors": errors}), 400
+            return state_response()
+        with state_write():
+            for k, v in data.items():
+                if k in ("rx", "tx", "coords", "angles") and isinstance(v, dict):
+                    state[k].update(v)
+                elif k == "logs" and isinstance(v, list):
+                    for line in v:
+                        add_log(str(line))
+                elif k == "log_seq":
+                    continue  # счётчик ведёт только add_log
+                else:
+                    state[k] = v
+    return state_response()
+
+@app.route("/api/batch", methods=["POST"])
+def api_batch():
+    changes, errors = apply_batch(request.get_json(silent=True))
+    if errors:
+        return jsonify({"ok": False, "errors": errors}), 400
+    return jsonify({"ok": True, "applied": changes})
 
 @app.route("/api/logs", methods=["GET"])
 def get_logs():
-    return jsonify({"logs": state["logs"]})
+    after = request.args.get("after")
+    limit = request.args.get("limit", str(LOG_PAGE_SIZE))
+    try:
+        after = int(after) if after not in (None, "") else None
+        limit = int(limit)
+    except ValueError:
+        abort(400, "Bad after/limit")
+    if limit < 0 or (after is not None and after < 0):
+        abort(400, "Bad after/limit")
+    return jsonify(query_logs(after, min(limit, LOG_STORE_SIZE)))
 
 @app.route("/api/log", methods=["POST"])
 def add_log_api():
@@ -507,45 +679,186 @@ def add_log_api():
     line = data.get("line")
     if not line:
         abort(400, "no 'line'")
-    add_log(str(line))
-    return jsonify({"logs": state["logs"]})
+    entry = add_log(str(line))
+    return jsonify({"entry": entry, "seq": entry["seq"]})
 
 # ===== Эндпоинты, которые дергает фронт (GET с query) =====
 @app.route("/api/wifi", methods=["GET"])
 def api_wifi():
     v = (request.args.get("state") or "").lower()
-    state["wifi_on"] = (v == "on")
-    return jsonify({"ok": True, "wifi_on": state["wifi_on"]})
+    with state_write():
+        state["wifi_on"] = (v == "on")
+    return jsonify({"ok": True, "wifi_on": v == "on"})
 
 @app.route("/api/coords/save", methods=["GET"])
 def api_coords_save():
-    lat = request.args.get("lat")
-    lng = request.args.get("lng")
-    if lat is not None:
-        vv = _to_float(lat, None)
-        if vv is not None: state["coords"]["lat"] = vv
-    if lng is not None:
-        vv = _to_float(lng, None)
-        if vv is not None: state["coords"]["lng"] = vv
-    return jsonify({"ok": True, "coords": state["coords"]})
+    lat = _to_float(request.args.get("lat"), None)
+    lng = _to_float(request.args.get("lng"), None)
+    with state_write():
+        if lat is not None: state["coords"]["lat"] = lat
+        if lng is not None: state["coords"]["lng"] = lng
+        coords = dict(state["coords"])
+    return jsonify({"ok": True, "coords": coords})
 
 @app.route("/api/wifi/password", methods=["GET"])
 def api_wifi_password():
     pwd = request.args.get("password", "")
-    state["wifi_password"] = pwd
-    return jsonify({"ok": True, "wifi_password": state["wifi_password"]})
+    with state_write():
+        state["wifi_password"] = pwd
+    return jsonify({"ok": True, "wifi_password": pwd})
 
 @app.route("/api/modem/power", methods=["GET"])
 def api_modem_power():
     v = (request.args.get("state") or "").lower()
-    state["power"] = (v == "on")
-    return jsonify({"ok": True, "power": state["power"]})
+    with state_write():
+        state["power"] = (v == "on")
+    return jsonify({"ok": True, "power": v == "on"})
 
 @app.route("/api/modem/off-temp", methods=["GET"])
 def api_modem_off_temp():
     v = (request.args.get("state") or "").lower()
-    state["modem_off_temp"] = (v == "on")
-    return jsonify({"ok": True, "modem_off_temp": state["modem_off_temp"]})
+    with state_write():
+        state["modem_off_temp"] = (v == "on")
+    return jsonify({"ok": True, "modem_off_temp": v == "on"})
+
+# ===== Сценарии: воспроизведение JSONL-таймлайна изменений state =====
+# Строка файла: {"t": сек от начала, "set": {...}, "log": "..."} — "set" сливается в state
+# (вложенные словари — по ключам), "log" добавляет строку лога. Пустые строки и "#..." пропускаются.
+# Готовые сценарии — scenarios/*.jsonl; запуск: SCENARIO=имя|путь (+ SCENARIO_SPEED, SCENARIO_LOOP)
+# или POST /api/scenario {"name": "...", "speed": 10, "loop": true}. speed=0 — без пауз (нагрузочные прогоны).
+SCENARIO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scenarios")
+
+def scenario_names():
+    try:
+        return sorted(f[:-6] for f in os.listdir(SCENARIO_DIR) if f.endswith(".jsonl"))
+    except OSError:
+        return []
+
+def load_scenario(path):
+    """Читает JSONL-таймлайн → список событий по возрастанию t. Ошибка формата — ValueError с номером строки."""
+    events = []
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                ev = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"{path}:{n}: {e}")
+            if (not isinstance(ev, dict) or not isinstance(ev.get("t", 0), (int, float))
+                    or not isinstance(ev.get("set", {}), dict)):
+                raise ValueError(f"{path}:{n}: expected {{\"t\": sec, \"set\": {{...}}, \"log\": \"...\"}}")
+            events.append(ev)
+    events.sort(key=lambda ev: ev.get("t", 0))  # sort стабилен: события с одним t — в порядке файла
+    return events
+
+def _merge(dst, src):
+    for k, v in src.items():
+        if isinstance(v, dict) and isinstance(dst.get(k), dict):
+            _merge(dst[k], v)
+        elif k != "log_seq":  # счётчик ведёт только add_log
+            dst[k] = v
+
+def apply_event(ev):
+    with state_write():
+        _merge(state, ev.get("set", {}))
+        if ev.get("log"):
+            add_log(str(ev["log"]), source="scenario")
+
+class ScenarioPlayer:
+    """Один поток воспроизведения; новый start() останавливает предыдущий сценарий."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.name, self.speed, self.loop = None, 1.0, False
+        self.events, self.position, self.passes = [], 0, 0
+
+    def start(self, name, events, speed=1.0, loop=False):
+        with self._lock:
+            self._halt()
+            self._stop = threading.Event()
+            self.name, self.speed, self.loop = name, speed, loop
+            self.events, self.position, self.passes = events, 0, 0
+            self._thread = threading.Thread(target=self._run, args=(self._stop,), daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._halt()
+
+    def _halt(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def info(self):
+        return {"name": self.name, "speed": self.speed, "loop": self.loop,
+                "running": self._thread is not None and self._thread.is_alive(),
+                "position": self.position, "events": len(self.events), "passes": self.passes,
+                "available": scenario_names()}
+
+    def _run(self, stop):
+        while not stop.is_set():
+            t0 = time.monotonic()
+            for i, ev in enumerate(self.events):
+                if self.speed > 0:
+                    delay = t0 + ev.get("t", 0) / self.speed - time.monotonic()
+                    if delay > 0 and stop.wait(delay):
+                        return
+                elif stop.is_set():
+                    return
+                apply_event(ev)
+                self.position = i + 1
+            self.passes += 1
+            if not self.loop or not self.events:
+                return
+
+SCENARIO = ScenarioPlayer()
+
+def _scenario_path(name):
+    """Имя из scenarios/ (для API — только оно) или путь к файлу."""
+    path = os.path.join(SCENARIO_DIR, f"{name}.jsonl")
+    return path if name in scenario_names() else None
+
+@app.route("/api/scenario", methods=["GET"])
+def api_scenario():
+    return jsonify(SCENARIO.info())
+
+@app.route("/api/scenario", methods=["POST"])
+def api_scenario_start():
+    data = request.get_json(silent=True) or {}
+    path = _scenario_path(str(data.get("name", "")))
+    if path is None:
+        abort(404, "unknown scenario")
+    speed = _to_float(data.get("speed", 1.0), None)
+    if speed is None or speed < 0:
+        abort(400, "speed must be >= 0")
+    try:
+        events = load_scenario(path)
+    except ValueError as e:
+        abort(400, str(e))
+    SCENARIO.start(data["name"], events, speed, bool(data.get("loop")))
+    return jsonify(SCENARIO.info())
+
+@app.route("/api/scenario", methods=["DELETE"])
+def api_scenario_stop():
+    SCENARIO.stop()
+    return jsonify(SCENARIO.info())
+
+def start_scenario_from_env():
+    name = os.environ.get("SCENARIO", "")
+    if not name:
+        return
+    path = _scenario_path(name) or name
+    SCENARIO.start(name, load_scenario(path), float(os.environ.get("SCENARIO_SPEED", "1")),
+                   os.environ.get("SCENARIO_LOOP", "0") in ("1", "true", "True"))
+
+# при импорте: bench/load_test.py --target flask запускает app.run через "import test"
+start_scenario_from_env()
 
 if __name__ == "__main__":
     app.run(host="127.0.0.1", port=8000, debug=True)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Запись и воспроизведение трафика UART без железа.
+
+  record — пишет сырые байты с настоящего порта с отметками времени в файл захвата:
+      python tools/uart_capture.py record field.cap --port /dev/ttyS1 --baud 115200 [--duration 600]
+
+  replay — создаёт псевдотерминал (pty) и проигрывает в него захват; сервер подключается к нему
+  как к обычному порту:
+      python tools/uart_capture.py replay field.cap --link /tmp/ttyV0 --speed 1
+      SERIAL_PORT=/tmp/ttyV0 FAKE_TEMP=0 python iot_simple_server.py
+  --speed N — в N раз быстрее, --speed 0 — без пауз (упор в читателя); --loop — по кругу.
+
+  import — сырой дамп (без времени) → захват с равномерным темпом по скорости порта:
+      python tools/uart_capture.py import dump.bin dump.cap --baud 115200
+
+Формат файла: CAP_MAGIC, затем записи CAP_CHUNK (смещение от начала, сек; длина) + байты.
+"""
+
+import os, sys, time, struct, argparse
+
+CAP_MAGIC = b"UARTCAP1"
+CAP_CHUNK = struct.Struct("<dI")
+
+
+def write_chunk(f, t:float, data:bytes):
+    f.write(CAP_CHUNK.pack(t, len(data)))
+    f.write(data)
+
+
+def read_capture(path:str):
+    """Итератор (смещение, байты) по файлу захвата."""
+    with open(path, "rb") as f:
+        if f.read(len(CAP_MAGIC)) != CAP_MAGIC:
+            raise SystemExit(f"{path}: не файл захвата (нет {CAP_MAGIC!r})")
+        while True:
+            head = f.read(CAP_CHUNK.size)
+            if len(head) < CAP_CHUNK.size:
+                return
+            t, n = CAP_CHUNK.unpack(head)
+            data = f.read(n)
+            if len(data) < n:
+                return  # недописанный хвост
+            yield t, data
+
+
+def load_bytes(path:str) -> bytes:
+    """Содержимое захвата одним куском (для бенчмарков); сырой файл — как есть."""
+    with open(path, "rb") as f:
+        magic = f.read(len(CAP_MAGIC))
+    if magic != CAP_MAGIC:
+        with open(path, "rb") as f:
+            return f.read()
+    return b"".join(data for _, data in read_capture(path))
+
+
+# ---- record ----
+def cmd_record(args):
+    try:
+        import serial
+    except ImportError:
+        raise SystemExit("нужен pyserial: pip install pyserial")
+    ser = serial.Serial(args.port, args.baud, timeout=0.2)
+    t0 = time.monotonic()
+    total = chunks = 0
+    with open(args.capture, "wb") as f:
+        f.write(CAP_MAGIC)
+        try:
+            while not args.duration or time.monotonic() - t0 < args.duration:
+                data = ser.read(ser.in_waiting or 1)
+                if not data:
+                    continue
+                write_chunk(f, time.monotonic() - t0, data)
+                total += len(data)
+                chunks += 1
+                if chunks % 100 == 0:
+                    f.flush()
+        except KeyboardInterrupt:
+            pass
+    print(f"записано {total} байт, {chunks} кусков, {time.monotonic() - t0:.1f} с", file=sys.stderr)
+
+
+# ---- replay ----
+def open_pty(link:str):
+    """pty в сыром режиме (без эха и замены \\n); возвращает (master fd, slave fd, путь)."""
+    import tty
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    path = os.ttyname(slave)
+    if link:
+        if os.path.islink(link):
+            os.remove(link)
+        os.symlink(path, link)
+        path = link
+    return master, slave, path
+
+
+def cmd_replay(args):
+    master, slave, path = open_pty(args.link)
+    print(f"pty: {path}", file=sys.stderr, flush=True)
+    total = 0
+    started = time.monotonic()
+    try:
+        if args.wait:
+            input("Enter — начать воспроизведение... ")
+        while True:
+            t0 = time.monotonic()
+            for t, data in read_capture(args.capture):
+                if args.speed > 0:
+                    delay = t0 + t / args.speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                view = memoryview(data)
+                while view:
+                    n = os.write(master, view)  # блокируется, пока читатель не заберёт буфер
+                    view = view[n:]
+                total += len(data)
+            if not args.loop:
+                break
+        elapsed = time.monotonic() - started
+        print(f"отдано {total} байт за {elapsed:.2f} с ({total / max(elapsed, 1e-9) / 1e6:.2f} МБ/с)",
+              file=sys.stderr)
+        if args.hold:
+            # держим pty открытым, чтобы читатель успел дочитать хвост
+            time.sleep(args.hold)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.close(master)
+        os.close(slave)
+        if args.link and os.path.islink(args.link):
+            os.remove(args.link)
+
+
+# ---- import ----
+def cmd_import(args):
+    with open(args.raw, "rb") as f:
+        data = f.read()
+    byte_time = 10.0 / args.baud  # 8N1: 10 бит на байт
+    with open(args.capture, "wb") as f:
+        f.write(CAP_MAGIC)
+        for i in range(0, len(data), args.chunk):
+            write_chunk(f, i * byte_time, data[i:i + args.chunk])
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    rec = sub.add_parser("record", help="запись с настоящего порта")
+    rec.add_argument("capture")
+    rec.add_argument("--port", default=os.environ.get("SERIAL_PORT", "COM3" if os.name == "nt" else "/dev/ttyS1"))
+    rec.add_argument("--baud", type=int, default=int(os.environ.get("BAUD_RATE", "115200")))
+    rec.add_argument("--duration", type=float, default=0, help="сек. (0 — до Ctrl+C)")
+    rec.set_defaults(fn=cmd_record)
+
+    rep = sub.add_parser("replay", help="воспроизведение в pty")
+    rep.add_argument("capture")
+    rep.add_argument("--link", default="", help="симлинк на pty (стабильный путь для SERIAL_PORT)")
+    rep.add_argument("--speed", type=float, default=1.0, help="множитель скорости, 0 — без пауз")
+    rep.add_argument("--loop", action="store_true", help="повторять по кругу")
+    rep.add_argument("--wait", action="store_true", help="ждать Enter перед стартом (успеть подключить сервер)")
+    rep.add_argument("--hold", type=float, default=1.0, help="сек. держать pty после конца захвата")
+    rep.set_defaults(fn=cmd_replay)
+
+    imp = sub.add_parser("import", help="сырой дамп → файл захвата")
+    imp.add_argument("raw")
+    imp.add_argument("capture")
+    imp.add_argument("--baud", type=int, default=115200)
+    imp.add_argument("--chunk", type=int, default=64, help="байт на запись (как кусок драйвера)")
+    imp.set_defaults(fn=cmd_import)
+
+    args = ap.parse_args()
+    if args.cmd == "replay" and not hasattr(os, "openpty"):
+        raise SystemExit("replay требует pty (Linux/macOS)")
+    args.fn(args)
+
+
+if __name__ == "__main__":
+    main()